@@ -1,23 +1,62 @@
 import jwt
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import HTTPException,Security
 from fastapi.security import HTTPAuthorizationCredentials,HTTPBearer
 from passlib.context import CryptContext
 from datetime import datetime,timedelta,timezone
 from dotenv import dotenv_values
+from cache import LRUCache
 
 config=dotenv_values('.env')
 
+BCRYPT_ROUNDS=int(config.get("BCRYPT_ROUNDS") or 12)
+# bcrypt releases the GIL, so a small thread pool keeps hashing off the event loop
+HASH_WORKERS=int(config.get("HASH_WORKERS") or 2)
+HASH_QUEUE_LIMIT=int(config.get("HASH_QUEUE_LIMIT") or 32)
+TOKEN_CACHE_SIZE=int(config.get("TOKEN_CACHE_SIZE") or 10000)
+
+# (secret, token) -> sub for tokens that already passed signature verification; entries expire with the token
+token_cache=LRUCache(maxsize=TOKEN_CACHE_SIZE)
+
 
 class Authhandler():
     security=HTTPBearer()
-    pwd_context=CryptContext(schemes=["bcrypt"],deprecated="auto")
+    # Pinning min/max to the configured cost makes needs_update flag hashes made with any other cost
+    pwd_context=CryptContext(
+        schemes=["bcrypt"],
+        deprecated="auto",
+        bcrypt__default_rounds=BCRYPT_ROUNDS,
+        bcrypt__min_rounds=BCRYPT_ROUNDS,
+        bcrypt__max_rounds=BCRYPT_ROUNDS,
+    )
     secret=config["SECRET"]
+    hash_executor=ThreadPoolExecutor(max_workers=HASH_WORKERS,thread_name_prefix="bcrypt")
+    hash_jobs_pending=0
 
     def get_password_hash(self,password):
         return self.pwd_context.hash(password)
     
     def verify_password(self,plain_password,hashed_password):
         return self.pwd_context.verify(plain_password,hashed_password)
+
+    async def run_hash_job(self,func,*args):
+        # Shed load instead of letting a login storm queue up behind the hash workers
+        if Authhandler.hash_jobs_pending>=HASH_QUEUE_LIMIT:
+            raise HTTPException(status_code=503,detail="Server busy, please retry",headers={"Retry-After":"1"})
+        Authhandler.hash_jobs_pending+=1
+        try:
+            loop=asyncio.get_running_loop()
+            return await loop.run_in_executor(self.hash_executor,func,*args)
+        finally:
+            Authhandler.hash_jobs_pending-=1
+
+    async def hash_password(self,password):
+        return await self.run_hash_job(self.pwd_context.hash,password)
+
+    async def verify_and_update_password(self,plain_password,hashed_password):
+        # Returns (valid, new_hash); new_hash is set when the stored hash uses outdated cost parameters
+        return await self.run_hash_job(self.pwd_context.verify_and_update,plain_password,hashed_password)
     
     def encode_token(self,user_id):
         payload={
@@ -30,8 +69,14 @@ class Authhandler():
         return jwt.encode(payload,self.secret,algorithm="HS256")
 
     def decode_token(self,token):
+        # Keyed by secret too, so rotating SECRET makes every cached verification unreachable
+        cache_key=(self.secret,token)
+        sub=token_cache.get(cache_key)
+        if sub is not None:
+            return sub
         try:
             payload=jwt.decode(token,self.secret,algorithms=['HS256'])
+            token_cache.set(cache_key,payload['sub'],expires_at=payload['exp'])
             return payload['sub']
         except jwt.ExpiredSignatureError:
             raise HTTPException(status_code=401,detail="Auth token expired")
@@ -0,0 +1,526 @@
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import io
+import itertools
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, List, Optional
+
+# Application modules read .env and resolve ./api.db when first imported, so they are imported inside
+# each benchmark, after the api benchmark has moved into its scratch directory
+
+
+def _percentile(sorted_values: List[float], percentile: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(percentile / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def _summarize(latencies: List[float], elapsed: float, errors: int, concurrency: int) -> Dict[str, float]:
+    ordered = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "concurrency": concurrency,
+        "rps": len(latencies) / elapsed if elapsed else 0.0,
+        "mean_ms": statistics.fmean(ordered) * 1000 if ordered else 0.0,
+        "p50_ms": _percentile(ordered, 50) * 1000,
+        "p95_ms": _percentile(ordered, 95) * 1000,
+        "p99_ms": _percentile(ordered, 99) * 1000,
+    }
+
+
+def _timed(func, repeat: int) -> List[float]:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def benchmark_serialization(args):
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse, ORJSONResponse
+    from pydantic import TypeAdapter
+    from sqlmodel import Session, SQLModel, create_engine, select
+
+    from db_schema import LISTING_FIELDS, Category, Listing, User
+
+    # In-memory database so the numbers measure row handling and encoding, not disk I/O
+    engine = create_engine("sqlite://")
+    SQLModel.metadata.create_all(engine)
+    now = datetime.now(timezone.utc)
+    images = {"images": ["http://localhost:8000/uploads/blobs/aa/bb/example.jpg"], "image_variants": []}
+    with Session(engine) as session:
+        session.add(User(email="bench@example.com", password="x" * 60, username="bench", created_at=now, updated_at=now))
+        session.add(Category(name="bench", created_at=now, updated_at=now))
+        session.add_all(
+            Listing(title=f"Listing {i}", description="A reasonably sized description " * 4, price=i % 500,
+                    category=1, user=1, created_at=now, updated_at=now)
+            for i in range(args.rows)
+        )
+        session.commit()
+
+        list_of_dicts = TypeAdapter(List[dict])
+
+        def before():
+            # ORM entities, listing.dict(), response_model validation, jsonable_encoder and stdlib json
+            listings = session.exec(select(Listing)).all()
+            content = [{**listing.dict(), **images} for listing in listings]
+            session.expunge_all()
+            return JSONResponse(jsonable_encoder(list_of_dicts.validate_python(content))).body
+
+        def after():
+            # Column-level select into plain dicts, encoded by orjson
+            rows = session.exec(select(*Listing.columns())).all()
+            content = [{**dict(zip(LISTING_FIELDS, row)), **images} for row in rows]
+            return ORJSONResponse(content).body
+
+        assert json.loads(before()) == json.loads(after())
+        results = {}
+        for name, func in (("before", before), ("after", after)):
+            timings = _timed(func, args.repeat)
+            results[name] = {
+                "median_ms": statistics.median(timings) * 1000,
+                "per_row_us": statistics.median(timings) / args.rows * 1_000_000,
+            }
+        results["speedup"] = results["before"]["median_ms"] / results["after"]["median_ms"]
+
+    print(json.dumps({"benchmark": "serialization", "rows": args.rows, "repeat": args.repeat, **results}, indent=2))
+
+BENCH_PASSWORD = "benchmark-password"
+
+
+def _make_jpeg(seed: int) -> bytes:
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new("RGB", (96, 96), ((seed * 37) % 256, (seed * 91) % 256, (seed * 53) % 256)).save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+def _write_env(workdir: str):
+    from dotenv import dotenv_values
+
+    # Start from the developer's settings so pool sizes, bcrypt cost and broker choice match what is being measured
+    values = {key: value for key, value in dotenv_values(".env").items() if value is not None}
+    values.setdefault("SECRET", "benchmark-secret")
+    values.setdefault("ADMIN_CODE", "benchmark-admin")
+    values["UPLOAD_ROOT"] = os.path.join(workdir, "uploads")
+    values["UPLOAD_TMP_DIR"] = os.path.join(workdir, ".upload_tmp")
+    values["CHAT_BROKER_PATH"] = os.path.join(workdir, "chat_outbox.db")
+    with open(os.path.join(workdir, ".env"), "w") as env_file:
+        env_file.writelines(f"{key}={value}\n" for key, value in values.items())
+
+
+def _seed(args) -> Dict[str, object]:
+    from sqlalchemy import insert
+
+    from auth import Authhandler
+    from database import engine, rebuild_search_index
+    from db_schema import Category, Conversation, Listing, ListingImage, Message, User
+    from storage import StoredBlob
+
+    rng = random.Random(args.seed)
+    now = datetime.now(timezone.utc)
+    password = Authhandler.pwd_context.hash(BENCH_PASSWORD)
+
+    blobs = []
+    for index in range(max(1, args.image_pool)):
+        data = _make_jpeg(index)
+        blob = StoredBlob(sha256=hashlib.sha256(data).hexdigest(), extension="jpg", size=len(data))
+        os.makedirs(os.path.dirname(blob.disk_path), exist_ok=True)
+        with open(blob.disk_path, "wb") as blob_file:
+            blob_file.write(data)
+        blobs.append(blob.path)
+
+    users = [
+        {"id": i, "email": f"bench{i}@example.com", "username": f"bench{i}", "password": password,
+         "created_at": now, "updated_at": now}
+        for i in range(1, args.users + 1)
+    ]
+    listings = []
+    item_counts = dict.fromkeys(range(1, args.categories + 1), 0)
+    for i in range(1, args.listings + 1):
+        created_at = now - timedelta(minutes=rng.randrange(60 * 24 * 90))
+        category = rng.randint(1, args.categories)
+        item_counts[category] += 1
+        listings.append({
+            "id": i, "title": f"Benchmark listing {i}", "description": f"Used item number {i} in good condition",
+            "price": round(rng.uniform(1, 500), 2), "category": category, "user": rng.randint(1, args.users),
+            "created_at": created_at, "updated_at": created_at,
+        })
+    categories = [
+        {"id": i, "name": f"category-{i}", "item_count": item_counts[i], "created_at": now, "updated_at": now}
+        for i in range(1, args.categories + 1)
+    ]
+    images = [
+        {"listing_id": listing["id"], "position": position, "path": rng.choice(blobs),
+         "created_at": now, "updated_at": now}
+        for listing in listings
+        for position in range(1, args.images_per_listing + 1)
+    ]
+
+    conversations: Dict[tuple, int] = {}
+    messages = []
+    if args.users > 1:
+        for i in range(args.messages):
+            listing = rng.choice(listings)
+            buyer = rng.choice([user for user in range(1, min(args.users, 50) + 1) if user != listing["user"]])
+            key = (listing["id"], min(buyer, listing["user"]), max(buyer, listing["user"]))
+            conversation_id = conversations.setdefault(key, len(conversations) + 1)
+            sender, receiver = (buyer, listing["user"]) if rng.random() < 0.5 else (listing["user"], buyer)
+            created_at = now - timedelta(seconds=args.messages - i)
+            messages.append({
+                "content": f"Benchmark message {i}", "sender_id": sender, "receiver_id": receiver,
+                "listing_id": listing["id"], "conversation_id": conversation_id,
+                "created_at": created_at, "updated_at": created_at,
+            })
+
+    # Core bulk inserts skip the ORM listeners, so timestamps are set above and the search index is rebuilt below
+    with engine.begin() as connection:
+        for model, rows in ((User, users), (Category, categories), (Listing, listings), (ListingImage, images)):
+            if rows:
+                connection.execute(insert(model), rows)
+        if conversations:
+            connection.execute(insert(Conversation), [
+                {"id": conversation_id, "listing_id": listing_id, "user_1": user_1, "user_2": user_2,
+                 "created_at": now, "updated_at": now}
+                for (listing_id, user_1, user_2), conversation_id in conversations.items()
+            ])
+        if messages:
+            connection.execute(insert(Message), messages)
+        rebuild_search_index(connection)
+
+    return {
+        "users": len(users), "categories": len(categories), "listings": len(listings), "images": len(images),
+        "conversations": len(conversations), "messages": len(messages),
+        "listing_owners": {listing["id"]: listing["user"] for listing in listings},
+    }
+
+
+class _AppLifespan:
+    """Runs the ASGI lifespan protocol around the benchmark, which httpx's ASGITransport does not do."""
+
+    def __init__(self, app):
+        self.app = app
+        self.receive_queue: asyncio.Queue = asyncio.Queue()
+        self.send_queue: asyncio.Queue = asyncio.Queue()
+        self.task: Optional[asyncio.Task] = None
+
+    async def __aenter__(self):
+        scope = {"type": "lifespan", "asgi": {"version": "3.0"}, "state": {}}
+        self.task = asyncio.create_task(self.app(scope, self.receive_queue.get, self.send_queue.put))
+        await self.receive_queue.put({"type": "lifespan.startup"})
+        message = await self.send_queue.get()
+        if message["type"] != "lifespan.startup.complete":
+            raise RuntimeError(f"Application startup failed: {message.get('message')}")
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.receive_queue.put({"type": "lifespan.shutdown"})
+        await self.send_queue.get()
+        await self.task
+
+
+class _WebSocketClient:
+    """Minimal in-process websocket client that speaks ASGI directly to the app."""
+
+    def __init__(self, app, path: str):
+        self.app = app
+        self.path = path
+        self.to_app: asyncio.Queue = asyncio.Queue()
+        self.from_app: asyncio.Queue = asyncio.Queue()
+        self.task: Optional[asyncio.Task] = None
+
+    async def connect(self):
+        scope = {
+            "type": "websocket", "asgi": {"version": "3.0"}, "scheme": "ws", "http_version": "1.1",
+            "path": self.path, "raw_path": self.path.encode(), "query_string": b"", "root_path": "",
+            "headers": [(b"host", b"bench")], "client": ("127.0.0.1", 0), "server": ("bench", 80),
+            "subprotocols": [], "state": {},
+        }
+        await self.to_app.put({"type": "websocket.connect"})
+        self.task = asyncio.create_task(self.app(scope, self.to_app.get, self.from_app.put))
+        message = await self.from_app.get()
+        if message["type"] != "websocket.accept":
+            raise RuntimeError(f"Websocket rejected: {message}")
+
+    async def send_json(self, data: dict):
+        await self.to_app.put({"type": "websocket.receive", "text": json.dumps(data)})
+
+    async def receive_json(self) -> dict:
+        message = await self.from_app.get()
+        if message["type"] == "websocket.close":
+            raise ConnectionError(f"Websocket closed: {message.get('reason')}")
+        return json.loads(message.get("text") or message["bytes"])
+
+    async def close(self):
+        await self.to_app.put({"type": "websocket.disconnect", "code": 1000})
+        try:
+            await asyncio.wait_for(self.task, timeout=5)
+        except (asyncio.TimeoutError, Exception):
+            self.task.cancel()
+
+
+async def _run_workload(total: int, concurrency: int, call: Callable[[int], Awaitable[bool]]) -> Dict[str, float]:
+    counter = itertools.count()
+    latencies: List[float] = []
+    errors = 0
+
+    async def worker():
+        nonlocal errors
+        while (index := next(counter)) < total:
+            start = time.perf_counter()
+            try:
+                ok = await call(index)
+            except Exception:
+                ok = False
+            latencies.append(time.perf_counter() - start)
+            if not ok:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(max(1, min(concurrency, total)))))
+    return _summarize(latencies, time.perf_counter() - start, errors, concurrency)
+
+
+async def _websocket_workload(app, args, tokens: Dict[int, str], listing_owners: Dict[int, int]) -> Dict[str, float]:
+    # Each pair is a buyer messaging the owner of one listing; latency runs from the sender's frame to the owner's receipt
+    pairs = []
+    for listing_id in list(listing_owners)[:args.ws_pairs]:
+        owner = listing_owners[listing_id]
+        buyer = owner % args.users + 1
+        pairs.append((listing_id, owner, buyer))
+
+    receivers, senders = [], []
+    for _, owner, buyer in pairs:
+        receivers.append(_WebSocketClient(app, f"/ws/{tokens[owner]}"))
+        senders.append(_WebSocketClient(app, f"/ws/{tokens[buyer]}"))
+    for client in receivers + senders:
+        await client.connect()
+
+    sent_at: Dict[tuple, float] = {}
+    latencies: List[float] = []
+
+    async def receive(pair_index: int, receiver: _WebSocketClient):
+        remaining = args.ws_messages
+        while remaining:
+            frame = await receiver.receive_json()
+            if frame.get("type") == "ping":
+                await receiver.send_json({"type": "pong"})
+                continue
+            if frame.get("type") != "message" or not frame["content"].startswith(f"bench {pair_index} "):
+                continue
+            key = (pair_index, int(frame["content"].rsplit(" ", 1)[1]))
+            latencies.append(time.perf_counter() - sent_at[key])
+            remaining -= 1
+
+    async def send(pair_index: int, sender: _WebSocketClient, listing_id: int, buyer: int):
+        for sequence in range(args.ws_messages):
+            sent_at[(pair_index, sequence)] = time.perf_counter()
+            await sender.send_json({"token": tokens[buyer], "listing_id": listing_id,
+                                    "message": f"bench {pair_index} {sequence}"})
+
+    start = time.perf_counter()
+    receiving = [asyncio.create_task(receive(i, receiver)) for i, receiver in enumerate(receivers)]
+    await asyncio.gather(*(send(i, sender, listing_id, buyer)
+                           for i, (sender, (listing_id, _, buyer)) in enumerate(zip(senders, pairs))))
+    done, pending = await asyncio.wait(receiving, timeout=args.ws_timeout)
+    elapsed = time.perf_counter() - start
+    for task in pending:
+        task.cancel()
+    for client in receivers + senders:
+        await client.close()
+
+    expected = len(pairs) * args.ws_messages
+    return _summarize(latencies, elapsed, expected - len(latencies), len(pairs))
+
+
+async def _run_api_benchmarks(args, seeded: Dict[str, object]) -> Dict[str, Dict[str, float]]:
+    import httpx
+
+    from auth import Authhandler
+    from db_schema import LISTING_SORT_KEYS, listing_page_cache
+    from images import shutdown_executor
+    from main import app
+    from web_socket import ws_connection_manager
+
+    auth_handler = Authhandler()
+    rng = random.Random(args.seed)
+    tokens = {user_id: auth_handler.encode_token(user_id) for user_id in range(1, args.users + 1)}
+    results: Dict[str, Dict[str, float]] = {}
+
+    async with _AppLifespan(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+
+            async def get(url: str, **kwargs) -> bool:
+                response = await client.get(url, **kwargs)
+                return response.status_code < 400
+
+            def listings_request(params: Dict[str, object], cached: bool, pages: int = 1):
+                if cached:
+                    return lambda _: get("/api/listings", params=params)
+
+                async def request(index: int) -> bool:
+                    # Every request renders its page: the cache is emptied and offset pages spread the queries
+                    listing_page_cache.clear()
+                    page_params = dict(params, offset=index % pages * args.page_size) if pages > 1 else params
+                    return await get("/api/listings", params=page_params)
+                return request
+
+            if "listings" in args.workloads:
+                # page_cache=hit repeats one URL, page_cache=miss measures the query and serialization path behind it
+                for sort_order in LISTING_SORT_KEYS:
+                    for category in [None, *range(1, args.categories + 1)]:
+                        params = {"limit": args.page_size}
+                        if sort_order:
+                            params["sort_order"] = sort_order
+                        if category:
+                            params["categories"] = category
+                        pages = max(1, args.listings // (args.categories if category else 1) // args.page_size)
+                        name = f"listings sort_order={sort_order or 'default'} categories={category or 'all'}"
+                        for cached in (True, False):
+                            results[f"{name} page_cache={'hit' if cached else 'miss'}"] = await _run_workload(
+                                args.requests, args.concurrency, listings_request(params, cached, pages)
+                            )
+                    keyset_params = {"limit": args.page_size, "cursor": ""}
+                    if sort_order:
+                        keyset_params["sort_order"] = sort_order
+                    for cached in (True, False):
+                        name = f"listings keyset sort_order={sort_order or 'default'} page_cache={'hit' if cached else 'miss'}"
+                        results[name] = await _run_workload(
+                            args.requests, args.concurrency, listings_request(keyset_params, cached)
+                        )
+
+            if "listing" in args.workloads:
+                results["listing"] = await _run_workload(
+                    args.requests, args.concurrency,
+                    lambda _: get(f"/api/listing/{rng.randint(1, args.listings)}"),
+                )
+
+            if "login" in args.workloads:
+                async def login(index: int) -> bool:
+                    user_id = index % args.users + 1
+                    response = await client.post(
+                        "/api/user/login", json={"email": f"bench{user_id}@example.com", "password": BENCH_PASSWORD}
+                    )
+                    return response.status_code < 400
+
+                results["login"] = await _run_workload(args.login_requests, args.concurrency, login)
+
+            if "create_listing" in args.workloads:
+                async def create_listing(index: int) -> bool:
+                    user_id = index % args.users + 1
+                    # A fresh image per request so every upload is a new blob, as with real photos
+                    image = _make_jpeg(args.image_pool + index) + index.to_bytes(4, "big")
+                    response = await client.post(
+                        "/api/listing",
+                        data={"title": f"Created listing {index}", "description": "Created by the benchmark",
+                              "price": "10", "category": str(index % args.categories + 1)},
+                        files=[("files", (f"{index}.jpg", image, "image/jpeg"))],
+                        headers={"Authorization": f"Bearer {tokens[user_id]}"},
+                    )
+                    return response.status_code < 400
+
+                results["create_listing"] = await _run_workload(args.create_requests, args.concurrency, create_listing)
+
+        if "websocket" in args.workloads:
+            results["websocket"] = await _websocket_workload(app, args, tokens, seeded["listing_owners"])
+            await ws_connection_manager.broker.stop()
+
+    shutdown_executor()
+    return results
+
+
+def _git_commit() -> Optional[str]:
+    import subprocess
+
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+API_WORKLOADS = ("listings", "listing", "login", "create_listing", "websocket")
+
+
+def benchmark_api(args):
+    # The app is driven in process against a throwaway database and upload tree, never the local api.db
+    original_cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="eagle-thrift-bench-")
+    try:
+        _write_env(workdir)
+        os.chdir(workdir)
+        # The app prints connection notices, so stdout is kept for the JSON report alone
+        with contextlib.redirect_stdout(sys.stderr):
+            seed_start = time.perf_counter()
+            seeded = _seed(args)
+            seed_seconds = time.perf_counter() - seed_start
+            results = asyncio.run(_run_api_benchmarks(args, seeded))
+    finally:
+        os.chdir(original_cwd)
+        if args.keep:
+            print(f"Benchmark data kept in {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    seeded.pop("listing_owners")
+    print(json.dumps({
+        "benchmark": "api",
+        "commit": _git_commit(),
+        "seed": {**seeded, "seconds": seed_seconds},
+        "workloads": results,
+    }, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the Eagle Thrift backend, results are printed as JSON")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serialization = subparsers.add_parser("serialization", help="Per-row cost of rendering listing pages")
+    serialization.add_argument("--rows", type=int, default=1000)
+    serialization.add_argument("--repeat", type=int, default=20)
+    serialization.set_defaults(func=benchmark_serialization)
+
+    api = subparsers.add_parser("api", help="Latency and throughput of the HTTP and websocket endpoints on seeded data")
+    api.add_argument("--users", type=int, default=50)
+    api.add_argument("--categories", type=int, default=5)
+    api.add_argument("--listings", type=int, default=2000)
+    api.add_argument("--images-per-listing", type=int, default=2)
+    api.add_argument("--image-pool", type=int, default=20, help="Distinct image blobs shared by the seeded listings")
+    api.add_argument("--messages", type=int, default=5000)
+    api.add_argument("--requests", type=int, default=200, help="Requests per listings/listing workload")
+    api.add_argument("--login-requests", type=int, default=50)
+    api.add_argument("--create-requests", type=int, default=50)
+    api.add_argument("--concurrency", type=int, default=10)
+    api.add_argument("--page-size", type=int, default=20)
+    api.add_argument("--ws-pairs", type=int, default=10, help="Sender/receiver socket pairs")
+    api.add_argument("--ws-messages", type=int, default=100, help="Messages sent per pair")
+    api.add_argument("--ws-timeout", type=float, default=60)
+    api.add_argument("--workloads", nargs="+", choices=API_WORKLOADS, default=list(API_WORKLOADS))
+    api.add_argument("--seed", type=int, default=1)
+    api.add_argument("--keep", action="store_true", help="Keep the scratch database and uploads for inspection")
+    api.set_defaults(func=benchmark_api)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
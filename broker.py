@@ -0,0 +1,133 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from dotenv import dotenv_values
+
+config = dotenv_values('.env')
+
+logger = logging.getLogger(__name__)
+
+# "inprocess" for a single worker, "sqlite" to route chat between workers on one host
+CHAT_BROKER = (config.get("CHAT_BROKER") or "inprocess").lower()
+CHAT_BROKER_PATH = config.get("CHAT_BROKER_PATH") or "./chat_outbox.db"
+CHAT_BROKER_POLL_INTERVAL = float(config.get("CHAT_BROKER_POLL_INTERVAL") or 0.05)
+CHAT_BROKER_RETENTION = float(config.get("CHAT_BROKER_RETENTION") or 60)
+
+Handler = Callable[[int, dict], Awaitable[None]]
+
+
+class Broker:
+    """Routes (user_id, payload) frames to every worker; each worker hands them to its local connections."""
+
+    def __init__(self, handler: Handler):
+        self.handler = handler
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, user_id: int, payload: dict):
+        raise NotImplementedError
+
+
+class InProcessBroker(Broker):
+    async def publish(self, user_id: int, payload: dict):
+        await self.handler(user_id, payload)
+
+
+class SQLiteOutboxBroker(Broker):
+    """Workers append to a shared SQLite outbox and tail it for rows they have not seen yet."""
+
+    def __init__(self, handler: Handler, path: str = CHAT_BROKER_PATH,
+                 poll_interval: float = CHAT_BROKER_POLL_INTERVAL, retention: float = CHAT_BROKER_RETENTION):
+        super().__init__(handler)
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention = retention
+        # sqlite3 connections are bound to their thread, so all outbox I/O goes through one thread
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chat-broker")
+        self.connection: Optional[sqlite3.Connection] = None
+        self.last_id = 0
+        self.poll_task: Optional[asyncio.Task] = None
+        # start() awaits before creating the task, so without this concurrent callers would each start a poll loop
+        self.start_lock = asyncio.Lock()
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def _connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS outbox ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, "
+                "payload TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+        return self.connection
+
+    def _latest_id(self) -> int:
+        return self._connect().execute("SELECT COALESCE(MAX(id), 0) FROM outbox").fetchone()[0]
+
+    def _insert(self, user_id: int, payload: str):
+        self._connect().execute(
+            "INSERT INTO outbox (user_id, payload, created_at) VALUES (?, ?, ?)", (user_id, payload, time.time())
+        )
+
+    def _fetch(self, after_id: int) -> List[Tuple[int, int, str]]:
+        return self._connect().execute(
+            "SELECT id, user_id, payload FROM outbox WHERE id > ? ORDER BY id LIMIT 500", (after_id,)
+        ).fetchall()
+
+    def _prune(self):
+        self._connect().execute("DELETE FROM outbox WHERE created_at < ?", (time.time() - self.retention,))
+
+    async def start(self):
+        async with self.start_lock:
+            if self.poll_task is not None:
+                return
+            # Only frames published after this worker started are its business
+            self.last_id = await self.run(self._latest_id)
+            self.poll_task = asyncio.create_task(self.poll_loop())
+
+    async def stop(self):
+        async with self.start_lock:
+            if self.poll_task is not None:
+                self.poll_task.cancel()
+                self.poll_task = None
+
+    async def publish(self, user_id: int, payload: dict):
+        await self.run(self._insert, user_id, json.dumps(payload))
+
+    async def poll_loop(self):
+        last_prune = time.monotonic()
+        while True:
+            try:
+                rows = await self.run(self._fetch, self.last_id)
+                for row_id, user_id, payload in rows:
+                    self.last_id = row_id
+                    await self.handler(user_id, json.loads(payload))
+                if time.monotonic() - last_prune > self.retention:
+                    await self.run(self._prune)
+                    last_prune = time.monotonic()
+                if len(rows) < 500:
+                    await asyncio.sleep(self.poll_interval)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Chat broker poll failed: %s", e)
+                await asyncio.sleep(self.poll_interval)
+
+
+def create_broker(handler: Handler) -> Broker:
+    if CHAT_BROKER == "sqlite":
+        return SQLiteOutboxBroker(handler)
+    return InProcessBroker(handler)
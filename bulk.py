@@ -0,0 +1,131 @@
+import csv
+import io
+from typing import AsyncIterator, List, Optional, Tuple
+
+import orjson
+from pydantic import ValidationError
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from dotenv import dotenv_values
+
+from database import async_session_maker
+from db_schema import LISTING_FIELDS, Listing, ListingImage
+from input_models import ListingImportModel
+
+config = dotenv_values('.env')
+
+# Rows per executemany/commit during an import
+IMPORT_CHUNK_SIZE = int(config.get("IMPORT_CHUNK_SIZE") or 500)
+IMPORT_MAX_LINE_BYTES = int(config.get("IMPORT_MAX_LINE_BYTES") or 64 * 1024)
+# Errors beyond this are counted but not listed, so a bad file cannot produce an unbounded report
+IMPORT_MAX_ERRORS = 1000
+# Rows fetched per round trip from the server-side cursor during an export
+EXPORT_BATCH_SIZE = int(config.get("EXPORT_BATCH_SIZE") or 1000)
+EXPORT_FORMATS = ("ndjson", "csv")
+
+
+async def iter_ndjson_lines(stream: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, Optional[bytes]]]:
+    """Yield (line number, line) from a byte stream; oversized lines are skipped and yielded as None."""
+    buffer = b""
+    line_number = 0
+    oversized = False
+    async for chunk in stream:
+        buffer += chunk
+        while True:
+            newline = buffer.find(b"\n")
+            if newline < 0:
+                break
+            line_number += 1
+            line, buffer = buffer[:newline], buffer[newline + 1:]
+            yield line_number, None if oversized or len(line) > IMPORT_MAX_LINE_BYTES else line
+            oversized = False
+        if len(buffer) > IMPORT_MAX_LINE_BYTES:
+            # Drop the partial line instead of buffering it, and report it once its end arrives
+            buffer = b""
+            oversized = True
+    if buffer or oversized:
+        yield line_number + 1, None if oversized or len(buffer) > IMPORT_MAX_LINE_BYTES else buffer
+
+
+def describe_validation_error(error: ValidationError) -> str:
+    return "; ".join(
+        f"{'.'.join(str(part) for part in detail['loc']) or 'line'}: {detail['msg']}" for detail in error.errors()
+    )
+
+
+async def import_listings_ndjson(session: AsyncSession, stream: AsyncIterator[bytes]) -> dict:
+    """Import one listing per NDJSON line in chunked transactions and report failures by line number.
+
+    Chunks that committed stay committed when later lines fail.
+    """
+    report = {"imported": 0, "failed": 0, "errors": []}
+    chunk: List[Tuple[int, dict]] = []
+
+    def record_error(line_number: int, detail: str):
+        report["failed"] += 1
+        if len(report["errors"]) < IMPORT_MAX_ERRORS:
+            report["errors"].append({"line": line_number, "error": detail})
+
+    async def flush():
+        results = await Listing.import_listings(session, [row for _, row in chunk])
+        for (line_number, _), result in zip(chunk, results):
+            if result is not None:
+                record_error(line_number, result.detail)
+            else:
+                report["imported"] += 1
+        chunk.clear()
+
+    async for line_number, line in iter_ndjson_lines(stream):
+        if line is None:
+            record_error(line_number, f"Line exceeds {IMPORT_MAX_LINE_BYTES} bytes")
+            continue
+        if not line.strip():
+            continue
+        try:
+            row = ListingImportModel.model_validate_json(line).model_dump()
+        except ValidationError as e:
+            record_error(line_number, describe_validation_error(e))
+            continue
+        chunk.append((line_number, row))
+        if len(chunk) >= IMPORT_CHUNK_SIZE:
+            await flush()
+    if chunk:
+        await flush()
+    # Parse errors are found while reading, database errors when a chunk is flushed
+    report["errors"].sort(key=lambda error: error["line"])
+    return report
+
+
+def format_csv(rows: List[list]) -> bytes:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue().encode()
+
+
+def csv_values(row: dict) -> list:
+    return [
+        " ".join(value) if field == "images" else value.isoformat() if hasattr(value, "isoformat") else value
+        for field, value in row.items()
+    ]
+
+
+async def export_listings(format: str) -> AsyncIterator[bytes]:
+    """Stream every listing in id order, holding one batch in memory at a time.
+
+    The generator opens its own sessions because it keeps running after the request's dependencies have
+    been torn down. Image paths come from a second session since some drivers cannot run another query
+    on a connection that is still streaming.
+    """
+    if format == "csv":
+        yield format_csv([list(LISTING_FIELDS) + ["images"]])
+    async with async_session_maker() as session, async_session_maker() as image_session:
+        result = await session.stream(
+            select(*Listing.columns()).order_by(Listing.id).execution_options(yield_per=EXPORT_BATCH_SIZE)
+        )
+        async for rows in result.partitions():
+            image_paths = await ListingImage.get_image_paths(image_session, [row.id for row in rows])
+            batch = [{**dict(zip(LISTING_FIELDS, row)), "images": image_paths.get(row.id, [])} for row in rows]
+            if format == "csv":
+                yield format_csv([csv_values(row) for row in batch])
+            else:
+                yield b"".join(orjson.dumps(row) + b"\n" for row in batch)
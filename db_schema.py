@@ -1,14 +1,110 @@
-from pydantic import EmailStr
-from typing import Optional,List
-from sqlmodel import Field,SQLModel,Session,select,Relationship
+from pydantic import EmailStr,field_serializer
+from typing import Optional,List,Dict,Tuple,Union
+from sqlmodel import Field,SQLModel,select,Relationship
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy import Index,and_,or_,case,func,insert,literal_column,column,table,tuple_,union_all,update
 from sqlalchemy.exc import IntegrityError
 from fastapi import HTTPException
-import os
+import base64
+import json
+import re
+import orjson
 
-from datetime import datetime
+from datetime import datetime,timezone
 
 
-from input_models import ConversationModel,UserModel,ListingModel,CategoryModel,MessageModel
+from images import VARIANT_KEY,ready_variant_paths
+from cache import LRUCache,SingleFlight
+from http_cache import make_etag
+from input_models import ConversationModel,UserModel,ListingModel,CategoryModel,MessageModel,ListingImageModel,DeliveryCursorModel
+
+IMAGE_BASE_URL = "http://localhost:8000"
+CONVERSATION_CACHE_SIZE = 50000
+# Bounds how stale another worker's category list can be after a create
+CATEGORY_CACHE_TTL = 300
+
+# Single entry: the rendered category list and its ETag
+category_cache = LRUCache(maxsize=1, ttl=CATEGORY_CACHE_TTL)
+
+# Rendered /api/listings bodies. Writes in this process invalidate the pages they touch; the TTL bounds
+# how long writes made by other workers can go unseen
+LISTING_PAGE_CACHE_SIZE = 2000
+LISTING_PAGE_CACHE_TTL = 30
+
+# (mode, categories, sort_order, offset or cursor, limit, price_min, price_max) -> JSON bytes
+listing_page_cache = LRUCache(maxsize=LISTING_PAGE_CACHE_SIZE, ttl=LISTING_PAGE_CACHE_TTL)
+listing_page_flight = SingleFlight()
+# Bumped on every invalidation so a render that started before a write is not cached after it
+listing_page_generation = 0
+
+
+def invalidate_listing_pages(category: int, price_low: float, price_high: float):
+    """Drop cached pages whose filter can include listings of this category within [price_low, price_high]."""
+    global listing_page_generation
+    listing_page_generation += 1
+    for key in listing_page_cache.keys():
+        _, categories, _, _, _, price_min, price_max = key
+        if categories is not None and category not in categories:
+            continue
+        if price_min is not None and price_high < price_min:
+            continue
+        if price_max is not None and price_low > price_max:
+            continue
+        listing_page_cache.pop(key)
+
+
+# (listing_id, low user id, high user id) -> conversation id; conversations are never re-keyed so entries never go stale
+conversation_cache = LRUCache(maxsize=CONVERSATION_CACHE_SIZE)
+
+# Upper bounds of the price histogram buckets on /api/listings/facets; the last bucket is open-ended
+PRICE_FACET_BOUNDS = (10, 25, 50, 100, 250, 500, 1000)
+
+LISTING_FIELDS = ("id", "title", "description", "price", "category", "user", "created_at", "updated_at")
+
+# sort_order -> (sort column, descending); every key is paired with id so keyset pages are stable
+LISTING_SORT_KEYS = {
+    None: (None, False),
+    "price_low_to_high": ("price", False),
+    "price_high_to_low": ("price", True),
+    "newest": ("created_at", True),
+    "oldest": ("created_at", False),
+}
+
+# FTS5 mirror of listing title/description, maintained by database.register_search_listeners
+listing_fts = table("listing_fts", column("rowid"), column("title"), column("description"))
+
+
+def build_match_query(q: str) -> str:
+    # Quote every term so user input can never be parsed as FTS5 syntax; the last term matches as a prefix
+    terms = re.findall(r"\w+", q)
+    if not terms:
+        raise HTTPException(status_code=400, detail="Search query must contain at least one word")
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += "*"
+    return " ".join(quoted)
+
+
+def image_url(path: str) -> str:
+    return f"{IMAGE_BASE_URL}/{path}"
+
+
+def encode_cursor(sort_order: Optional[str], key, id: int) -> str:
+    if isinstance(key, datetime):
+        key = key.isoformat()
+    raw = json.dumps({"s": sort_order, "k": key, "i": id}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, sort_order: Optional[str]):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        data = json.loads(raw)
+        key, id = data["k"], int(data["i"])
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if data.get("s") != sort_order:
+        raise HTTPException(status_code=400, detail="Cursor does not match sort_order")
+    return key, id
 
 class TimeStampedData(SQLModel):
     created_at: Optional[datetime] = Field(default=None, nullable=False)
@@ -19,98 +115,239 @@ class User(UserModel,TimeStampedData,table=True):
     id:Optional[int]=Field(default=None,primary_key=True)
     email: EmailStr=Field(...,unique=True)
     phone_number:Optional[str]=Field(None,min_length=10)
+    # Served path of the current avatar blob, e.g. uploads/blobs/ab/cd/<sha>.jpg
+    avatar_path:Optional[str]=Field(default=None,max_length=500)
+    # images.VARIANT_KEY once the avatar's variants have been written
+    avatar_variants_key:Optional[str]=Field(default=None,max_length=100)
 
     @classmethod
-    def create(cls, session: Session, user: "User") -> str:
+    async def create(cls, session: AsyncSession, user: "User") -> str:
         try:
             session.add(user)
-            session.commit()
-            session.refresh(user)
+            await session.commit()
+            await session.refresh(user)
             return {f'User with email {user.email} created successfully'}
         except IntegrityError as e:
-            session.rollback()
+            await session.rollback()
             raise HTTPException(status_code=400, detail=str(e.orig))
 
     @classmethod
-    def get_user(cls,email:EmailStr, session: Session):
+    async def get_user(cls,email:EmailStr, session: AsyncSession):
         statement=select(cls).where(cls.email==email)
-        user=session.exec(statement).first()
+        user=(await session.exec(statement)).first()
         if user:
             return user
         raise HTTPException(status_code=404,detail="User not found")
 
+    @classmethod
+    async def update_password(cls, session: AsyncSession, user: "User", hashed_password: str):
+        user.password = hashed_password
+        session.add(user)
+        await session.commit()
+
+    @classmethod
+    async def set_avatar(cls, session: AsyncSession, user: "User", path: str):
+        user.avatar_path = path
+        user.avatar_variants_key = None
+        session.add(user)
+        await session.commit()
+
+    @classmethod
+    async def mark_avatar_variants_ready(cls, session: AsyncSession, paths: List[str]):
+        await session.exec(update(cls).where(cls.avatar_path.in_(paths)).values(avatar_variants_key=VARIANT_KEY))
+        await session.commit()
+
+    @classmethod
+    async def get_avatars(cls, session: AsyncSession, user_ids: List[int]) -> List[dict]:
+        # One query for the whole batch; users that do not exist come back with no avatar
+        rows = (await session.exec(
+            select(cls.id, cls.avatar_path, cls.avatar_variants_key).where(cls.id.in_(user_ids))
+        )).all()
+        avatar_rows = {user_id: (path, variants_key) for user_id, path, variants_key in rows}
+        avatars = []
+        for user_id in user_ids:
+            path, variants_key = avatar_rows.get(user_id, (None, None))
+            avatars.append({
+                "id": user_id,
+                "avatar": image_url(path) if path else None,
+                "variants": {
+                    variant: image_url(variant_path) for variant, variant_path in ready_variant_paths(path, variants_key).items()
+                } if path else {},
+            })
+        return avatars
+
 class Category(CategoryModel,TimeStampedData,table=True):
     id:Optional[int]=Field(default=None,primary_key=True)
     name:str=Field(...,nullable=False,unique=True)
     item_count:Optional[int]=Field(default=0)
 
     @classmethod
-    def create(cls, session: Session, category: "Category") -> str:
+    async def create(cls, session: AsyncSession, category: "Category") -> str:
         try:
             session.add(category)
-            session.commit()
-            session.refresh(category)
+            await session.commit()
+            await session.refresh(category)
+            category_cache.clear()
             return {f'{category.name} created successfully'}
         except IntegrityError as e:
-            session.rollback()
+            await session.rollback()
             raise HTTPException(status_code=400, detail=str(e.orig))
         
     @classmethod
-    def get_all_categories(cls,session:Session):
+    async def get_all_categories(cls,session:AsyncSession):
         statement = select(cls)
-        results = session.exec(statement)
+        results = await session.exec(statement)
         items = results.all()
         return items
+
+    @classmethod
+    async def get_cached_categories(cls, session: AsyncSession) -> Tuple[List[dict], str]:
+        cached = category_cache.get("all")
+        if cached is not None:
+            return cached
+        rows = (await session.exec(select(cls.id, cls.name).order_by(cls.id))).all()
+        categories = [{"name": name, "id": id} for id, name in rows]
+        etag = make_etag(json.dumps(categories, separators=(",", ":")).encode())
+        category_cache.set("all", (categories, etag))
+        return categories, etag
       
 
 class Listing(ListingModel,TimeStampedData,table=True):
     id:Optional[int]=Field(default=None,primary_key=True)
     user:int=Field(default=None,foreign_key="user.id",nullable=False)
     category:int=Field(default=0,foreign_key="category.id",nullable=False)
+
+    __table_args__ = (
+        Index("ix_listing_category_price_id", "category", "price", "id"),
+        Index("ix_listing_category_created_at_id", "category", "created_at", "id"),
+        Index("ix_listing_price_id", "price", "id"),
+        Index("ix_listing_created_at_id", "created_at", "id"),
+    )
+
     @classmethod
-    def create(cls,user:int,session:Session,listing:"Listing")->str:
+    async def create(cls,user:int,session:AsyncSession,listing:"Listing",image_paths:List[str]=())->str:
         listing.user=user
         try:
             session.add(listing)
-            session.commit()
-            session.refresh(listing)
+            if image_paths:
+                # The listing and its images commit together, so no page is rendered with the listing but without images
+                await session.flush()
+                session.add_all(
+                    ListingImage(listing_id=listing.id, position=position, path=path)
+                    for position, path in enumerate(image_paths, start=1)
+                )
+            # Counted in the same transaction, so item_count never drifts from the inserted rows
+            await session.exec(
+                update(Category)
+                .where(Category.id == listing.category)
+                .values(item_count=func.coalesce(Category.item_count, 0) + 1)
+            )
+            await session.commit()
+            await session.refresh(listing)
+            invalidate_listing_pages(listing.category, listing.price, listing.price)
             return(listing)
         except IntegrityError as e:
-            session.rollback()
+            await session.rollback()
             raise HTTPException(status_code=400, detail=str(e.orig))
 
+    @classmethod
+    async def import_listings(cls, session: AsyncSession, rows: List[dict]) -> List[Optional[HTTPException]]:
+        """Insert a chunk of validated listing dicts with one executemany, in one transaction.
+
+        Rows that cannot be stored get an HTTPException in their slot, stored rows get None.
+        """
+        user_ids = set((await session.exec(select(User.id).where(User.id.in_({row["user"] for row in rows})))).all())
+        category_ids = set((await session.exec(select(Category.id).where(Category.id.in_({row["category"] for row in rows})))).all())
+
+        results: List[Optional[HTTPException]] = [None] * len(rows)
+        valid = []
+        for index, row in enumerate(rows):
+            if row["user"] not in user_ids:
+                results[index] = HTTPException(status_code=404, detail="User not found")
+            elif row["category"] not in category_ids:
+                results[index] = HTTPException(status_code=404, detail="Category not found")
+            else:
+                valid.append(index)
+        if not valid:
+            return results
+
+        # Bulk inserts skip the mapper listeners, so timestamps, the search index and item_count are maintained here
+        now = datetime.now(timezone.utc)
+        params = [{**rows[index], "created_at": now, "updated_at": now} for index in valid]
+        try:
+            if (await session.connection()).dialect.name == "sqlite":
+                # RETURNING order is not guaranteed, so the search rows are built from the returned values themselves
+                inserted = (await session.exec(insert(cls).returning(cls.id, cls.title, cls.description), params=params)).all()
+                await session.exec(insert(listing_fts), params=[
+                    {"rowid": id, "title": title, "description": description} for id, title, description in inserted
+                ])
+            else:
+                await session.exec(insert(cls), params=params)
+            added: Dict[int, int] = {}
+            for row in params:
+                added[row["category"]] = added.get(row["category"], 0) + 1
+            for category_id, count in added.items():
+                await session.exec(
+                    update(Category)
+                    .where(Category.id == category_id)
+                    .values(item_count=func.coalesce(Category.item_count, 0) + count)
+                )
+            await session.commit()
+            for category_id in added:
+                prices = [row["price"] for row in params if row["category"] == category_id]
+                invalidate_listing_pages(category_id, min(prices), max(prices))
+        except IntegrityError as e:
+            await session.rollback()
+            if len(valid) == 1:
+                results[valid[0]] = HTTPException(status_code=400, detail=str(e.orig))
+                return results
+            # Retry row by row so only the offending rows are reported
+            for index in valid:
+                results[index] = (await cls.import_listings(session, [rows[index]]))[0]
+            return results
+        return results
+
+    @classmethod
+    def columns(cls):
+        # Only what the listing JSON needs, selected as plain rows instead of hydrated ORM objects
+        return [getattr(cls, field) for field in LISTING_FIELDS]
+
     @classmethod   
-    def get_single_listing(cls,id:int,session:Session):
-        listing = session.get(cls, id)
+    async def get_single_listing(cls,id:int,session:AsyncSession):
+        listing = (await session.exec(select(*cls.columns()).where(cls.id == id))).first()
         if not listing:
             raise HTTPException(status_code=404, detail="Listing not found")
-        # Construct image URLs
-        image_folder_path = f"uploads/listings/{id}"
+        return (await cls.attach_images(session, [listing]))[0]
 
-        if os.path.exists(image_folder_path) and os.path.isdir(image_folder_path):
-            image_files = os.listdir(image_folder_path)
-            image_urls = [f"http://localhost:8000/{image_folder_path}/{image_file}" for image_file in image_files]
-        else:
-            image_urls = []
-
-        listing_dict = listing.dict()
-        listing_dict['images'] = image_urls
-        return listing_dict
+    @classmethod
+    async def attach_images(cls, session: AsyncSession, listings) -> List[dict]:
+        # One query for the whole page instead of a directory scan per listing
+        images = await ListingImage.get_images(session, [listing.id for listing in listings])
+        listings_with_images = []
+        for listing in listings:
+            listing_images = images.get(listing.id, [])
+            listing_dict = dict(zip(LISTING_FIELDS, listing))
+            listing_dict['images'] = [image_url(path) for path, _ in listing_images]
+            # Parallel to images: smaller renditions clients can pick from, empty until they have been generated
+            listing_dict['image_variants'] = [
+                {variant: image_url(variant_path) for variant, variant_path in ready_variant_paths(path, variants_key).items()}
+                for path, variants_key in listing_images
+            ]
+            listings_with_images.append(listing_dict)
+        return listings_with_images
     
     @classmethod
-    def get_multiple_listings(
+    async def get_multiple_listings(
         cls,
-        session: Session,
+        session: AsyncSession,
         offset: int = 0,
         limit: int = 100,
         categories: Optional[List[int]] = None,
-        sort_order: Optional[str] = None
+        sort_order: Optional[str] = None,
+        price_min: Optional[float] = None,
+        price_max: Optional[float] = None
     ) -> List[dict]:
-        query = select(cls)
-        
-        if categories!=None :
-            if 0 not in categories:
-                query = query.where(cls.category.in_(categories))
+        query = cls.apply_filters(select(*cls.columns()), categories, price_min, price_max)
         
         if sort_order:
             if sort_order == "price_low_to_high":
@@ -123,48 +360,432 @@ class Listing(ListingModel,TimeStampedData,table=True):
                 query = query.order_by(cls.created_at.asc())
         
         query = query.offset(offset).limit(limit)
-        results = session.exec(query)
+        results = await session.exec(query)
         listings = results.all()
 
-        listings_with_images = []
-        for listing in listings:
-            image_folder_path = f"uploads/listings/{listing.id}"
-            if os.path.exists(image_folder_path) and os.path.isdir(image_folder_path):
-                image_files = os.listdir(image_folder_path)
-                image_urls = [f"http://localhost:8000/{image_folder_path}/{image_file}" for image_file in image_files]
-            else:
-                image_urls = []
-            listing_dict = listing.dict()
-            listing_dict['images'] = image_urls
-            listings_with_images.append(listing_dict)
-        return listings_with_images
+        return await cls.attach_images(session, listings)
     
     @classmethod
-    def get_all_user_listings(cls,session=Session,user_id=int):
-        query=select(cls).where(cls.user==user_id)
-        results=session.exec(query)
-        listings=results.all()
-        listings_with_images = []
-        for listing in listings:
-            image_folder_path = f"uploads/listings/{listing.id}"
-            if os.path.exists(image_folder_path) and os.path.isdir(image_folder_path):
-                image_files = os.listdir(image_folder_path)
-                image_urls = [f"http://localhost:8000/{image_folder_path}/{image_file}" for image_file in image_files]
+    async def get_rendered_page(
+        cls,
+        session: AsyncSession,
+        offset: int = 0,
+        limit: int = 100,
+        categories: Optional[List[int]] = None,
+        sort_order: Optional[str] = None,
+        cursor: Optional[str] = None,
+        price_min: Optional[float] = None,
+        price_max: Optional[float] = None
+    ) -> bytes:
+        """JSON body of a /api/listings page, served from listing_page_cache when possible.
+
+        Concurrent misses on the same key share one query through listing_page_flight.
+        """
+        normalized = None if categories is None or 0 in categories else tuple(sorted(set(categories)))
+        if cursor is not None:
+            key = ("cursor", normalized, sort_order, cursor, limit, price_min, price_max)
+        else:
+            key = ("offset", normalized, sort_order, offset, limit, price_min, price_max)
+        body = listing_page_cache.get(key)
+        if body is not None:
+            return body
+
+        async def render() -> bytes:
+            generation = listing_page_generation
+            if cursor is not None:
+                page = await cls.get_listings_page(session, limit, categories, sort_order, cursor, price_min, price_max)
             else:
-                image_urls = []
-            listing_dict = listing.dict()
-            listing_dict['images'] = image_urls
-            listings_with_images.append(listing_dict)
-        return listings_with_images
+                page = await cls.get_multiple_listings(session, offset, limit, categories, sort_order, price_min, price_max)
+            rendered = orjson.dumps(page)
+            if generation == listing_page_generation:
+                listing_page_cache.set(key, rendered)
+            return rendered
+
+        return await listing_page_flight.do(key, render)
+
+    @classmethod
+    def category_filter(cls, categories: Optional[List[int]]):
+        # Category 0 means "all categories"
+        if categories is None or 0 in categories:
+            return None
+        return cls.category.in_(categories)
+
+    @classmethod
+    def price_filter(cls, price_min: Optional[float], price_max: Optional[float]):
+        if price_min is not None and price_max is not None and price_min > price_max:
+            raise HTTPException(status_code=400, detail="price_min cannot be greater than price_max")
+        conditions = []
+        if price_min is not None:
+            conditions.append(cls.price >= price_min)
+        if price_max is not None:
+            conditions.append(cls.price <= price_max)
+        return and_(*conditions) if conditions else None
+
+    @classmethod
+    def apply_filters(cls, query, categories: Optional[List[int]] = None, price_min: Optional[float] = None, price_max: Optional[float] = None):
+        for condition in (cls.category_filter(categories), cls.price_filter(price_min, price_max)):
+            if condition is not None:
+                query = query.where(condition)
+        return query
+
+    @classmethod
+    def apply_keyset(cls, query, sort_order: Optional[str], cursor: Optional[str]):
+        if sort_order not in LISTING_SORT_KEYS:
+            raise HTTPException(status_code=400, detail=f"Unknown sort_order {sort_order}")
+        column_name, descending = LISTING_SORT_KEYS[sort_order]
+        column = getattr(cls, column_name) if column_name else None
+
+        if cursor:
+            key, last_id = decode_cursor(cursor, sort_order)
+            if column is None:
+                query = query.where(cls.id > last_id)
+            else:
+                if column_name == "created_at":
+                    key = datetime.fromisoformat(key)
+                if descending:
+                    query = query.where(or_(column < key, and_(column == key, cls.id < last_id)))
+                else:
+                    query = query.where(or_(column > key, and_(column == key, cls.id > last_id)))
+
+        if column is None:
+            return query.order_by(cls.id.asc())
+        if descending:
+            return query.order_by(column.desc(), cls.id.desc())
+        return query.order_by(column.asc(), cls.id.asc())
+
+    @classmethod
+    def next_cursor(cls, listing, sort_order: Optional[str]) -> str:
+        column_name, _ = LISTING_SORT_KEYS[sort_order]
+        key = getattr(listing, column_name) if column_name else None
+        return encode_cursor(sort_order, key, listing.id)
+
+    @classmethod
+    async def get_listings_page(
+        cls,
+        session: AsyncSession,
+        limit: int = 100,
+        categories: Optional[List[int]] = None,
+        sort_order: Optional[str] = None,
+        cursor: Optional[str] = None,
+        price_min: Optional[float] = None,
+        price_max: Optional[float] = None
+    ) -> dict:
+        query = cls.apply_filters(select(*cls.columns()), categories, price_min, price_max)
+        query = cls.apply_keyset(query, sort_order, cursor)
+
+        # Fetch one extra row to find out whether another page exists
+        listings = (await session.exec(query.limit(limit + 1))).all()
+        next_cursor = None
+        if len(listings) > limit:
+            listings = listings[:limit]
+            next_cursor = cls.next_cursor(listings[-1], sort_order)
+        return {"listings": await cls.attach_images(session, listings), "next_cursor": next_cursor}
+
+    @classmethod
+    async def search(
+        cls,
+        session: AsyncSession,
+        q: str,
+        limit: int = 100,
+        categories: Optional[List[int]] = None,
+        sort_order: Optional[str] = None,
+        cursor: Optional[str] = None
+    ) -> dict:
+        # The full-text index is an SQLite FTS5 table, which other databases do not have
+        if session.bind.dialect.name != "sqlite":
+            raise HTTPException(status_code=501, detail="Listing search is only available on SQLite databases")
+        rank = func.bm25(literal_column("listing_fts"))
+        query = (
+            select(*cls.columns(), rank.label("rank"))
+            .join(listing_fts, listing_fts.c.rowid == cls.id)
+            .where(literal_column("listing_fts").op("MATCH")(build_match_query(q)))
+        )
+        query = cls.apply_filters(query, categories)
+
+        if sort_order is None:
+            # bm25 is lower for better matches, ties broken by id
+            if cursor:
+                last_rank, last_id = decode_cursor(cursor, "relevance")
+                query = query.where(or_(rank > last_rank, and_(rank == last_rank, cls.id > last_id)))
+            query = query.order_by(rank.asc(), cls.id.asc())
+        else:
+            query = cls.apply_keyset(query, sort_order, cursor)
+
+        rows = (await session.exec(query.limit(limit + 1))).all()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            if sort_order is None:
+                next_cursor = encode_cursor("relevance", rows[-1].rank, rows[-1].id)
+            else:
+                next_cursor = cls.next_cursor(rows[-1], sort_order)
+        return {"listings": await cls.attach_images(session, rows), "next_cursor": next_cursor}
+
+    @classmethod
+    async def get_facets(
+        cls,
+        session: AsyncSession,
+        categories: Optional[List[int]] = None,
+        price_min: Optional[float] = None,
+        price_max: Optional[float] = None
+    ) -> dict:
+        # Each facet ignores its own filter so the sidebar still shows the other choices: category counts
+        # honour the price range, the price histogram honours the categories. Both come from one grouped
+        # query over (category, price), which the category/price index covers.
+        bucket = case(*((cls.price < bound, index) for index, bound in enumerate(PRICE_FACET_BOUNDS)), else_=len(PRICE_FACET_BOUNDS))
+        price_condition = cls.price_filter(price_min, price_max)
+        in_price_range = func.sum(case((price_condition, 1), else_=0)) if price_condition is not None else func.count()
+        query = (
+            select(cls.category, bucket.label("bucket"), func.count().label("count"), in_price_range.label("in_price_range"),
+                   func.min(cls.price).label("min_price"), func.max(cls.price).label("max_price"))
+            .group_by(cls.category, bucket)
+        )
+        rows = (await session.exec(query)).all()
+
+        selected = None if categories is None or 0 in categories else set(categories)
+        category_counts: Dict[int, int] = {}
+        bucket_counts = [0] * (len(PRICE_FACET_BOUNDS) + 1)
+        total = 0
+        observed_min = observed_max = None
+        for row in rows:
+            category_counts[row.category] = category_counts.get(row.category, 0) + row.in_price_range
+            if selected is None or row.category in selected:
+                bucket_counts[row.bucket] += row.count
+                total += row.in_price_range
+                observed_min = row.min_price if observed_min is None else min(observed_min, row.min_price)
+                observed_max = row.max_price if observed_max is None else max(observed_max, row.max_price)
+
+        category_list, _ = await Category.get_cached_categories(session)
+        lower_bounds = (0,) + PRICE_FACET_BOUNDS
+        upper_bounds = PRICE_FACET_BOUNDS + (None,)
+        return {
+            "total": total,
+            "categories": [
+                {"id": category["id"], "name": category["name"], "count": category_counts.get(category["id"], 0)}
+                for category in category_list
+            ],
+            "price_buckets": [
+                {"min": low, "max": high, "count": count}
+                for low, high, count in zip(lower_bounds, upper_bounds, bucket_counts)
+            ],
+            "price_range": {"min": observed_min, "max": observed_max},
+        }
+
+    @classmethod
+    async def get_all_user_listings(cls,session:AsyncSession,user_id:int):
+        query=select(*cls.columns()).where(cls.user==user_id)
+        results=await session.exec(query)
+        listings=results.all()
+        return await cls.attach_images(session, listings)
+
+
+class ListingImage(ListingImageModel, TimeStampedData, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    listing_id: int = Field(foreign_key="listing.id", index=True)
+    position: int = Field(default=1)
+    path: str = Field(..., max_length=500)
+    # images.VARIANT_KEY once this image's variants have been written
+    variants_key: Optional[str] = Field(default=None, max_length=100)
+
+    @classmethod
+    async def mark_variants_ready(cls, session: AsyncSession, paths: List[str]):
+        await session.exec(update(cls).where(cls.path.in_(paths)).values(variants_key=VARIANT_KEY))
+        await session.commit()
+        # Rendered listing pages list the variants, so the pages showing these images are rebuilt
+        listings = (await session.exec(
+            select(Listing.category, Listing.price).join(cls, cls.listing_id == Listing.id).where(cls.path.in_(paths))
+        )).all()
+        for category, price in set(listings):
+            invalidate_listing_pages(category, price, price)
+
+    @classmethod
+    async def get_images(cls, session: AsyncSession, listing_ids: List[int]) -> Dict[int, List[Tuple[str, Optional[str]]]]:
+        """(path, variants_key) of each listing's images, in position order."""
+        if not listing_ids:
+            return {}
+        statement = (
+            select(cls.listing_id, cls.path, cls.variants_key)
+            .where(cls.listing_id.in_(listing_ids))
+            .order_by(cls.listing_id, cls.position)
+        )
+        images: Dict[int, List[Tuple[str, Optional[str]]]] = {}
+        for listing_id, path, variants_key in await session.exec(statement):
+            images.setdefault(listing_id, []).append((path, variants_key))
+        return images
+
+    @classmethod
+    async def get_image_paths(cls, session: AsyncSession, listing_ids: List[int]) -> Dict[int, List[str]]:
+        if not listing_ids:
+            return {}
+        statement = (
+            select(cls.listing_id, cls.path)
+            .where(cls.listing_id.in_(listing_ids))
+            .order_by(cls.listing_id, cls.position)
+        )
+        image_paths: Dict[int, List[str]] = {}
+        for listing_id, path in await session.exec(statement):
+            image_paths.setdefault(listing_id, []).append(path)
+        return image_paths
 
 
 class Conversation(ConversationModel, TimeStampedData, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     listing_id: int = Field(foreign_key="listing.id")
+    # Stored canonically with user_1 < user_2, so a participant pair maps to exactly one row per listing
     user_1: int = Field(foreign_key="user.id")
     user_2: int = Field(foreign_key="user.id")
+    # Highest message id each participant has read, used for unread counts
+    user_1_last_read_id: int = Field(default=0)
+    user_2_last_read_id: int = Field(default=0)
     messages: List["Message"] = Relationship(back_populates="conversation")
 
+    __table_args__ = (
+        Index("ux_conversation_listing_users", "listing_id", "user_1", "user_2", unique=True),
+        Index("ix_conversation_user_1", "user_1"),
+        Index("ix_conversation_user_2", "user_2"),
+    )
+
+    @classmethod
+    async def get_inbox(cls, session: AsyncSession, user_id: int, limit: int = 20, cursor: Optional[str] = None) -> dict:
+        # Each side of the pair is a separate indexed lookup instead of one OR
+        mine = union_all(
+            select(
+                cls.id.label("conversation_id"), cls.listing_id,
+                cls.user_2.label("counterpart_id"), cls.user_1_last_read_id.label("last_read_id"),
+            ).where(cls.user_1 == user_id),
+            select(
+                cls.id.label("conversation_id"), cls.listing_id,
+                cls.user_1.label("counterpart_id"), cls.user_2_last_read_id.label("last_read_id"),
+            ).where(cls.user_2 == user_id),
+        ).subquery("mine")
+        last_message_id = (
+            select(func.max(Message.id)).where(Message.conversation_id == mine.c.conversation_id).scalar_subquery()
+        )
+        unread_count = (
+            select(func.count()).select_from(Message).where(
+                Message.conversation_id == mine.c.conversation_id,
+                Message.receiver_id == user_id,
+                Message.id > mine.c.last_read_id,
+            ).scalar_subquery()
+        )
+        inbox = select(
+            mine.c.conversation_id, mine.c.listing_id, mine.c.counterpart_id,
+            last_message_id.label("last_message_id"), unread_count.label("unread_count"),
+        ).subquery("inbox")
+
+        query = (
+            select(
+                inbox.c.conversation_id, inbox.c.listing_id, inbox.c.counterpart_id, User.username,
+                inbox.c.last_message_id, inbox.c.unread_count,
+                Message.content, Message.sender_id, Message.created_at,
+            )
+            .join(User, User.id == inbox.c.counterpart_id)
+            .join(Message, Message.id == inbox.c.last_message_id)
+        )
+        if cursor:
+            # A message belongs to one conversation, so its id alone orders the inbox without ties
+            _, last_message = decode_cursor(cursor, "inbox")
+            query = query.where(inbox.c.last_message_id < last_message)
+        query = query.order_by(inbox.c.last_message_id.desc()).limit(limit + 1)
+
+        rows = (await session.exec(query)).all()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor("inbox", None, rows[-1].last_message_id)
+        conversations = [
+            {
+                "id": row.conversation_id,
+                "listing_id": row.listing_id,
+                "counterpart": {"id": row.counterpart_id, "username": row.username},
+                "last_message": {
+                    "id": row.last_message_id,
+                    "content": row.content,
+                    "sender_id": row.sender_id,
+                    "created_at": row.created_at,
+                },
+                "unread_count": row.unread_count,
+            }
+            for row in rows
+        ]
+        return {"conversations": conversations, "next_cursor": next_cursor}
+
+    @classmethod
+    async def get_messages(
+        cls, session: AsyncSession, conversation_id: int, user_id: int, limit: int = 50, cursor: Optional[str] = None
+    ) -> dict:
+        conversation = await session.get(cls, conversation_id)
+        if not conversation or user_id not in (conversation.user_1, conversation.user_2):
+            raise HTTPException(status_code=404, detail="Conversation not found")
+
+        # Newest first, walking backwards along the (conversation_id, id) index
+        query = select(Message).where(Message.conversation_id == conversation_id)
+        if cursor:
+            _, last_id = decode_cursor(cursor, "messages")
+            query = query.where(Message.id < last_id)
+        messages = (await session.exec(query.order_by(Message.id.desc()).limit(limit + 1))).all()
+        next_cursor = None
+        if len(messages) > limit:
+            messages = messages[:limit]
+            next_cursor = encode_cursor("messages", None, messages[-1].id)
+
+        # Opening the latest page marks the conversation as read
+        if not cursor and messages:
+            await cls.mark_read(session, conversation, user_id, messages[0].id)
+        return {"messages": messages, "next_cursor": next_cursor}
+
+    @classmethod
+    async def mark_read(cls, session: AsyncSession, conversation: "Conversation", user_id: int, message_id: int):
+        column = cls.user_1_last_read_id if conversation.user_1 == user_id else cls.user_2_last_read_id
+        await session.exec(
+            update(cls).where(cls.id == conversation.id, column < message_id).values({column: message_id})
+        )
+        await session.commit()
+
+    @staticmethod
+    def conversation_key(listing_id: int, user_a: int, user_b: int) -> Tuple[int, int, int]:
+        return (listing_id, min(user_a, user_b), max(user_a, user_b))
+
+    @classmethod
+    async def resolve_ids(cls, session: AsyncSession, keys) -> Dict[Tuple[int, int, int], int]:
+        """Map conversation keys to ids, creating missing conversations in the caller's transaction."""
+        resolved = {}
+        missing = set()
+        for key in keys:
+            conversation_id = conversation_cache.get(key)
+            if conversation_id is None:
+                missing.add(key)
+            else:
+                resolved[key] = conversation_id
+        if not missing:
+            return resolved
+
+        async def lookup(keys_to_find):
+            statement = select(cls.id, cls.listing_id, cls.user_1, cls.user_2).where(
+                tuple_(cls.listing_id, cls.user_1, cls.user_2).in_(list(keys_to_find))
+            )
+            for conversation_id, listing_id, user_1, user_2 in (await session.exec(statement)).all():
+                key = (listing_id, user_1, user_2)
+                resolved[key] = conversation_id
+                conversation_cache.set(key, conversation_id)
+                missing.discard(key)
+
+        await lookup(missing)
+        for key in sorted(missing):
+            listing_id, user_1, user_2 = key
+            conversation = cls(listing_id=listing_id, user_1=user_1, user_2=user_2)
+            try:
+                # A savepoint inside the batch's transaction: losing a race to another worker only undoes this
+                # insert, and a later rollback of the batch removes the conversation too
+                async with session.begin_nested():
+                    session.add(conversation)
+            except IntegrityError:
+                await lookup({key})
+                continue
+            # Not cached yet: the caller's transaction could still roll back
+            resolved[key] = conversation.id
+        return resolved
+
 
 class Message(MessageModel, TimeStampedData, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
@@ -175,12 +796,31 @@ class Message(MessageModel, TimeStampedData, table=True):
     conversation_id: int = Field(foreign_key="conversation.id")
     conversation: Conversation = Relationship(back_populates="messages")
 
+    __table_args__ = (
+        Index("ix_message_conversation_id_id", "conversation_id", "id"),
+        Index("ix_message_receiver_id_created_at", "receiver_id", "created_at"),
+        Index("ix_message_receiver_id_id", "receiver_id", "id"),
+    )
+
+    @field_serializer("created_at", "updated_at")
+    def serialize_timestamp(self, value: Optional[datetime]) -> Optional[datetime]:
+        # Timestamps are written in UTC but SQLite returns them naive, so reloaded rows would otherwise
+        # serialize without the Z that live frames carry
+        if value is not None and value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value
+
+    @classmethod
+    async def get_backlog(cls, session: AsyncSession, user_id: int, after_id: int, limit: int) -> List["Message"]:
+        statement = select(cls).where(cls.receiver_id == user_id, cls.id > after_id).order_by(cls.id.asc()).limit(limit)
+        return (await session.exec(statement)).all()
+
     @classmethod
-    def get_all_messages(cls, user_id: int, session: Session) -> dict:
+    async def get_all_messages(cls, user_id: int, session: AsyncSession) -> dict:
         statement = select(cls).where(
             (cls.sender_id == user_id) | (cls.receiver_id == user_id)
         )
-        messages = session.exec(statement).all()
+        messages = (await session.exec(statement)).all()
         grouped_messages = {}
         for message in messages:
             if message.conversation_id not in grouped_messages:
@@ -189,54 +829,95 @@ class Message(MessageModel, TimeStampedData, table=True):
         return grouped_messages
 
     @classmethod
-    def create_message(cls, session: Session, listing_id: int, sender_id: int, content: str) -> str:
-        listing = session.get(Listing, listing_id)
-        if not listing:
-            raise HTTPException(status_code=404, detail="Listing not found")
+    async def create_messages(
+        cls, session: AsyncSession, requests: List[Tuple[int, int, str]]
+    ) -> List[Union["Message", HTTPException]]:
+        """Insert a batch of (listing_id, sender_id, content) in one transaction, in request order.
 
-        # Check if a conversation already exists
-        conversation = session.exec(
-            select(Conversation).where(
-                Conversation.listing_id == listing_id,
-                (Conversation.user_1 == sender_id) | (Conversation.user_2 == sender_id)
-            )
-        ).first()
-        print(conversation)
+        Requests that cannot be stored get an HTTPException in their slot instead of a Message.
+        """
+        listing_ids = {listing_id for listing_id, _, _ in requests}
+        listings = {
+            listing.id: listing
+            for listing in (await session.exec(select(Listing).where(Listing.id.in_(listing_ids)))).all()
+        }
 
-        if not conversation:
-            # Determine receiver_id based on the listing owner
-            receiver_id = listing.user
-            if receiver_id == sender_id:
-                receiver_id = listing.user if listing.user != sender_id else None
+        # Senders never own the listing (checked below), so every message goes to the listing owner's pair
+        keys = {
+            Conversation.conversation_key(listing_id, sender_id, listings[listing_id].user)
+            for listing_id, sender_id, _ in requests
+            if listing_id in listings and listings[listing_id].user != sender_id
+        }
+        conversation_ids = await Conversation.resolve_ids(session, keys)
+
+        results = []
+        for listing_id, sender_id, content in requests:
+            listing = listings.get(listing_id)
+            if not listing:
+                results.append(HTTPException(status_code=404, detail="Listing not found"))
+                continue
+            if listing.user == sender_id:
+                results.append(HTTPException(status_code=400, detail="Sender and receiver cannot be the same"))
+                continue
 
-            # Create a new conversation if it doesn't exist
-            conversation = Conversation(
+            receiver_id = listing.user
+            conversation_id = conversation_ids[Conversation.conversation_key(listing_id, sender_id, receiver_id)]
+            message = cls(
+                content=content,
+                sender_id=sender_id,
+                receiver_id=receiver_id,
                 listing_id=listing_id,
-                user_1=sender_id,
-                user_2=receiver_id,
+                conversation_id=conversation_id
             )
-            session.add(conversation)
-            session.commit()
-            session.refresh(conversation)
-        else:
-            # Determine receiver_id based on the conversation
-            receiver_id = conversation.user_1 if conversation.user_2 == sender_id else conversation.user_2
-
-        # Save message to the database
-        message = cls(
-            content=content,
-            sender_id=sender_id,
-            receiver_id=receiver_id,
-            listing_id=listing_id,
-            conversation_id=conversation.id
-        )
+            session.add(message)
+            results.append(message)
+
+        await session.commit()
+        return results
+
+
+class DeliveryCursor(DeliveryCursorModel, TimeStampedData, table=True):
+    user_id: int = Field(foreign_key="user.id", primary_key=True)
+    # Every message to this user with id <= acked_message_id has been acknowledged by one of their clients
+    acked_message_id: int = Field(default=0)
 
+    @classmethod
+    async def get_or_create(cls, session: AsyncSession, user_id: int) -> "DeliveryCursor":
+        cursor = await session.get(cls, user_id)
+        if cursor:
+            return cursor
+        # A user's first cursor starts at their newest message; older history is served by the conversation APIs
+        latest = (await session.exec(select(func.max(Message.id)).where(Message.receiver_id == user_id))).first()
+        cursor = cls(user_id=user_id, acked_message_id=latest or 0)
         try:
-            session.add(message)
-            session.commit()
-            session.refresh(message)
-            return message
-        except IntegrityError as e:
-            session.rollback()
-            raise HTTPException(status_code=400, detail=str(e.orig))
+            session.add(cursor)
+            await session.commit()
+        except IntegrityError:
+            await session.rollback()
+            cursor = await session.get(cls, user_id)
+        return cursor
 
+    @classmethod
+    async def acknowledge(cls, session: AsyncSession, user_id: int, ranges: List[Tuple[int, int]]) -> int:
+        """Advance the cursor over acked (from_id, to_id) ranges, stopping at the first unacknowledged gap."""
+        if any(from_id > to_id for from_id, to_id in ranges):
+            raise HTTPException(status_code=400, detail="Ack range starts after it ends")
+        cursor = await cls.get_or_create(session, user_id)
+        acked = cursor.acked_message_id
+        # A range past the user's newest message would otherwise skip messages that do not exist yet
+        latest = (await session.exec(select(func.max(Message.id)).where(Message.receiver_id == user_id))).first() or 0
+        for from_id, to_id in sorted(ranges):
+            to_id = min(to_id, latest)
+            if to_id <= acked:
+                continue
+            gap = (await session.exec(
+                select(Message.id).where(Message.receiver_id == user_id, Message.id > acked, Message.id < from_id).limit(1)
+            )).first()
+            if gap is not None:
+                break
+            acked = to_id
+        if acked != cursor.acked_message_id:
+            cursor.acked_message_id = acked
+            session.add(cursor)
+            await session.commit()
+        return acked
@@ -0,0 +1,137 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+
+from PIL import Image, ImageOps
+from dotenv import dotenv_values
+
+from storage import disk_path_for
+
+config = dotenv_values('.env')
+
+logger = logging.getLogger(__name__)
+
+IMAGE_WORKERS = int(config.get("IMAGE_WORKERS") or 2)
+VARIANT_FORMAT = (config.get("IMAGE_VARIANT_FORMAT") or "webp").lower()
+VARIANT_EXTENSION = "webp" if VARIANT_FORMAT == "webp" else "jpg"
+VARIANT_QUALITY = int(config.get("IMAGE_VARIANT_QUALITY") or 80)
+# Bump to re-render every variant under new names after a rendering change that keeps size, format and quality
+VARIANT_VERSION = int(config.get("IMAGE_VARIANT_VERSION") or 1)
+
+# thumb is cropped to an exact square for listing grids, medium is bounded by its longest side
+THUMB_SIZE = 320
+MEDIUM_SIZE = 1024
+VARIANT_SIZES = {"thumb": THUMB_SIZE, "medium": MEDIUM_SIZE}
+VARIANTS = tuple(VARIANT_SIZES)
+# Stored on image rows once their variants exist for these settings; rows with any other key are served without variants
+VARIANT_KEY = f"{THUMB_SIZE}-{MEDIUM_SIZE}-{VARIANT_FORMAT}-q{VARIANT_QUALITY}-v{VARIANT_VERSION}"
+# Variant names carry every rendering parameter, e.g. <sha>_thumb320q80v1.webp, so the bytes behind a name never change
+VARIANT_SUFFIX = rf"_(?:{'|'.join(VARIANTS)})\d+q\d+v\d+"
+# Also matches the unversioned <name>_thumb.webp files written before parameters were part of the name
+VARIANT_NAME_PATTERN = re.compile(rf"(?:{VARIANT_SUFFIX}|_(?:{'|'.join(VARIANTS)}))$")
+
+_executor: Optional[ProcessPoolExecutor] = None
+_pending = set()
+
+
+def variant_path(path: str, variant: str) -> str:
+    root, _ = os.path.splitext(path)
+    return f"{root}_{variant}{VARIANT_SIZES[variant]}q{VARIANT_QUALITY}v{VARIANT_VERSION}.{VARIANT_EXTENSION}"
+
+
+def variant_paths(path: str) -> Dict[str, str]:
+    return {variant: variant_path(path, variant) for variant in VARIANTS}
+
+
+def ready_variant_paths(path: str, variants_key: Optional[str]) -> Dict[str, str]:
+    # Until generation has succeeded the variant files may not exist, so clients fall back to the original
+    return variant_paths(path) if variants_key == VARIANT_KEY else {}
+
+
+def is_variant(filename: str) -> bool:
+    root, _ = os.path.splitext(filename)
+    return VARIANT_NAME_PATTERN.search(root) is not None
+
+
+def _render(image: Image.Image, variant: str) -> Image.Image:
+    if variant == "thumb":
+        return ImageOps.fit(image, (THUMB_SIZE, THUMB_SIZE), Image.LANCZOS)
+    image = image.copy()
+    image.thumbnail((MEDIUM_SIZE, MEDIUM_SIZE), Image.LANCZOS)
+    return image
+
+
+def generate_variants(source: str) -> List[str]:
+    """Write every missing variant next to source (a path on disk). Runs in worker processes.
+
+    Existing variants are never rewritten: they may already be cached as immutable.
+    """
+    targets = {variant: variant_path(source, variant) for variant in VARIANTS}
+    missing = {variant: target for variant, target in targets.items() if not os.path.exists(target)}
+    if not missing:
+        return []
+
+    with Image.open(source) as original:
+        image = ImageOps.exif_transpose(original)
+        if VARIANT_FORMAT == "webp":
+            image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+        else:
+            image = image.convert("RGB")
+
+        written = []
+        for variant, target in missing.items():
+            tmp_target = f"{target}.{os.getpid()}.part"
+            _render(image, variant).save(tmp_target, format=VARIANT_FORMAT.upper(), quality=VARIANT_QUALITY)
+            os.replace(tmp_target, target)
+            written.append(target)
+    return written
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        # spawn avoids forking a process that already runs the event loop and database threads
+        _executor = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _executor
+
+
+async def _generate(paths: List[str], on_ready: Optional[Callable[[List[str]], Awaitable[None]]]):
+    loop = asyncio.get_running_loop()
+    try:
+        futures = [loop.run_in_executor(get_executor(), generate_variants, disk_path_for(path)) for path in paths]
+    except Exception as e:
+        # A broken or unstartable pool must not fail the request that already stored the images
+        logger.error("Could not queue image variant generation: %s", e)
+        return
+    ready = []
+    for path, result in zip(paths, await asyncio.gather(*futures, return_exceptions=True)):
+        if isinstance(result, BaseException):
+            logger.error("Image variant generation failed for %s: %s", path, result)
+        else:
+            ready.append(path)
+    if ready and on_ready is not None:
+        try:
+            await on_ready(ready)
+        except Exception as e:
+            logger.error("Could not record image variants for %s: %s", ready, e)
+
+
+def schedule_variants(paths: Iterable[str], on_ready: Optional[Callable[[List[str]], Awaitable[None]]] = None):
+    """Queue variant generation for served upload paths without waiting for it.
+
+    on_ready is awaited with the paths whose variants were written, so they can be recorded as servable.
+    """
+    task = asyncio.get_running_loop().create_task(_generate(list(dict.fromkeys(paths)), on_ready))
+    _pending.add(task)
+    task.add_done_callback(_pending.discard)
+
+
+def shutdown_executor(wait: bool = True):
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=wait)
+        _executor = None
@@ -20,6 +20,15 @@ class ListingModel(SQLModel):
     price:float=Field(...,ge=0,le=1000000000)
     category:int=Field(...,ge=1)
 
+class ListingImportModel(ListingModel):
+    # Imported listings name their owner instead of taking it from the auth token
+    user:int=Field(...,ge=1)
+
+class ListingImageModel(SQLModel):
+    listing_id: int = Field(foreign_key="listing.id")
+    position: int = Field(default=1)
+    path: str = Field(...)
+
 class AdminIdModel(BaseModel):
     id:str=Field(...)
 
@@ -37,4 +46,9 @@ class MessageModel(SQLModel):
 class ConversationModel(SQLModel):
     listing_id: int = Field(foreign_key="listing.id")
     user_1: int = Field(foreign_key="user.id")
-    user_2: int = Field(foreign_key="user.id")
\ No newline at end of file
+    user_2: int = Field(foreign_key="user.id")
+
+
+class DeliveryCursorModel(SQLModel):
+    user_id: int = Field(foreign_key="user.id")
+    acked_message_id: int = Field(default=0)
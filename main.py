@@ -1,21 +1,38 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect,Query,Depends,HTTPException,UploadFile,File,Form
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect,Query,Depends,HTTPException,UploadFile,File,Form,Request,Response,Header
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
-from typing import List,Optional
-from db_schema import  User,Listing,Category,Message # Ensure you have these models defined appropriately
-from database import get_session
-import shutil
-
-from sqlmodel import Session,select
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse,PlainTextResponse,StreamingResponse
+from typing import List,Optional,Union
+from db_schema import  User,Listing,ListingImage,Category,Message,Conversation,conversation_cache,category_cache,listing_page_cache # Ensure you have these models defined appropriately
+from database import async_session_maker,get_async_session,get_read_session
+
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 from dotenv import dotenv_values
 import os
+import secrets
 
 from input_models import UserModel,ListingModel,LoginModel,CategoryModel,AdminIdModel,CategoryResponse
-from auth import Authhandler
+from auth import Authhandler,token_cache
+from storage import StoredBlob,UPLOAD_ROOT,store_upload
+from images import schedule_variants
+from http_cache import etag_matches,make_etag
+from static_files import UploadFiles
+from metrics import MetricsMiddleware,render_metrics,watch_cache
+from bulk import EXPORT_FORMATS,export_listings,import_listings_ndjson
 
 
 from web_socket import websocket_endpoint
 
+class APIGZipMiddleware(GZipMiddleware):
+    # Uploaded images are already compressed and must stay byte-addressable, so only API responses are gzipped
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].startswith("/uploads"):
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+
 app = FastAPI()
 
 # Configure CORS
@@ -30,95 +47,130 @@ app.add_middleware(
 
 auth_handler=Authhandler()
 
+# Enough for a full inbox page of counterparts in one request
+MAX_AVATAR_BATCH=100
+
 config=dotenv_values('.env')
 
-MAX_FILE_SIZE = 5 * 1024 * 1024  # 5MB
-ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg"}
-UPLOAD_DIR = os.path.join(os.path.dirname(__file__), 'uploads', 'listings')
+app.add_middleware(APIGZipMiddleware, minimum_size=int(config.get("GZIP_MINIMUM_SIZE") or 1024))
+# Added last so it is outermost and its timings include compression
+app.add_middleware(MetricsMiddleware)
 
-def is_allowed_file(filename: str) -> bool:
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+watch_cache("token", token_cache)
+watch_cache("conversation", conversation_cache)
+watch_cache("category", category_cache)
+watch_cache("listing_page", listing_page_cache)
 
-async def validate_and_upload_files(files: List[UploadFile] = File(...)):
-    for file in files:
-        contents = await file.read()
-        if len(contents) > MAX_FILE_SIZE:
-            raise HTTPException(status_code=400, detail=f"File {file.filename} exceeds the maximum size of 5MB")
-        if not is_allowed_file(file.filename):
-            raise HTTPException(status_code=400, detail=f"File {file.filename} is not an allowed image type (png, jpg, jpeg)")
-        
-        file.file.seek(0)  # Reset the file read pointers after reading
+async def record_variants(paths: List[str]):
+    # Variant URLs are only returned for images recorded here, so clients never get a link that 404s
+    async with async_session_maker() as session:
+        await ListingImage.mark_variants_ready(session, paths)
+        await User.mark_avatar_variants_ready(session, paths)
 
-    return files
+async def validate_and_upload_files(files: List[UploadFile] = File(...)) -> List[StoredBlob]:
+    # Each file is streamed to content-addressed storage in chunks, checking size and magic bytes as it goes
+    return [await store_upload(file) for file in files]
 
 
 # Mount the static files directory
-app.mount("/uploads", StaticFiles(directory=os.path.join(os.path.dirname(__file__), 'uploads')), name="uploads")
+os.makedirs(UPLOAD_ROOT, exist_ok=True)
+app.mount("/uploads", UploadFiles(directory=UPLOAD_ROOT), name="uploads")
+
+def verify_admin_code(x_admin_code: Optional[str] = Header(None)):
+    # Same ADMIN_CODE check as add_category, sent as a header because these bodies are not JSON objects
+    if x_admin_code is None or not secrets.compare_digest(x_admin_code, config["ADMIN_CODE"]):
+        raise HTTPException(status_code=401,detail="Unauthorized route")
 
 #===========================================Category Related Routes========================================
 @app.post("/api/category/create")
-async def add_category(admin_id:AdminIdModel,category:CategoryModel,session:Session=Depends(get_session)):
+async def add_category(admin_id:AdminIdModel,category:CategoryModel,session: AsyncSession = Depends(get_async_session)):
     if admin_id.id==config["ADMIN_CODE"]:
         category_data=Category.model_validate(category)
-        return Category.create(category=category_data,session=session)
+        return await Category.create(category=category_data,session=session)
     raise HTTPException(status_code=401,detail="Unauthorized route")
 
 @app.get("/api/categories",response_model=List[CategoryResponse])
-async def get_all_categories(session:Session=Depends(get_session)):
-    categories=Category.get_all_categories(session=session)
+async def get_all_categories(request:Request,response:Response,session: AsyncSession = Depends(get_read_session)):
+    categories,etag=await Category.get_cached_categories(session=session)
+    if etag_matches(request.headers.get("if-none-match"),etag):
+        return Response(status_code=304,headers={"ETag":etag,"Cache-Control":"no-cache"})
+    response.headers["ETag"]=etag
+    response.headers["Cache-Control"]="no-cache"
     return categories
 
 
 
 #=============================================User related routes===========================================================================
 @app.post("/api/user/register")
-async def user_registration(user:UserModel,session:Session=Depends(get_session)):
+async def user_registration(user:UserModel,session: AsyncSession = Depends(get_async_session)):
     user_data=User.model_validate(user)
-    hashed_password=auth_handler.get_password_hash(user_data.password)
+    hashed_password=await auth_handler.hash_password(user_data.password)
     user_data.password=hashed_password
-    return User.create(user=user_data,session=session)
+    return await User.create(user=user_data,session=session)
     
 
 @app.post("/api/user/login")
-async def user_login(user:LoginModel,session:Session=Depends(get_session)):
+async def user_login(user:LoginModel,session: AsyncSession = Depends(get_async_session)):
     print(user)
-    result=User.get_user(user.email,session=session)
-    if not auth_handler.verify_password(user.password,result.password):
+    result=await User.get_user(user.email,session=session)
+    valid,new_hash=await auth_handler.verify_and_update_password(user.password,result.password)
+    if not valid:
         raise HTTPException(status_code=401,detail="Invalid email or password")
+    if new_hash:
+        await User.update_password(user=result,hashed_password=new_hash,session=session)
     token= auth_handler.encode_token(result.id)
     return{"token":token,"username":result.username,"email":result.email,"id":result.id}
 
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    # Prometheus text exposition format
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
 @app.post("/api/user/profile_image")
 async def upload_profile_image(
     user_id: int = Depends(auth_handler.auth_wrapper),
-    file: List[UploadFile] = Depends(validate_and_upload_files),
-    session: Session = Depends(get_session),
+    file: List[StoredBlob] = Depends(validate_and_upload_files),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    user = session.get(User, user_id)
+    user = await session.get(User, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
-    profile_folder = f"uploads/profiles/{user_id}/"
-    os.makedirs(profile_folder, exist_ok=True)
-    
-    # Delete existing files in the folder
-    for filename in os.listdir(profile_folder):
-        file_path = os.path.join(profile_folder, filename)
-        if os.path.isfile(file_path):
-            os.unlink(file_path)
-    
-    # Save new file
-    file_location = os.path.join(profile_folder, file[0].filename)
-    with open(file_location, "wb") as buffer:
-        shutil.copyfileobj(file[0].file, buffer)
-
-    return {f'localhost:8000/uploads/profiles/{user_id}/{file[0].filename}'}
+    # Recorded on the user row so avatar lookups never touch the filesystem
+    await User.set_avatar(session=session, user=user, path=file[0].path)
+    schedule_variants([file[0].path], record_variants)
+    # The content-addressed URL is immutable, so a new avatar always gets a new URL
+    return {f'localhost:8000/{file[0].path}'}
 
 @app.get('/api/user/profile_image/{user_id}')
-async def get_user_image(user_id:int):
-    profile_folder = f"uploads/profiles/{user_id}/"
-    file= os.listdir(profile_folder)[0]
-    return {f'localhost:8000/uploads/profiles/{user_id}/{file.filename}'}
+async def get_user_image(user_id:int,session: AsyncSession = Depends(get_read_session)):
+    user = await session.get(User, user_id)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    if not user.avatar_path:
+        raise HTTPException(status_code=404, detail="User has no profile image")
+    return {f'localhost:8000/{user.avatar_path}'}
+
+@app.get("/api/users/avatars", response_class=ORJSONResponse)
+async def get_user_avatars(
+    request: Request,
+    ids: List[str] = Query(..., description="User ids, repeated (ids=1&ids=2) or comma-separated (ids=1,2)"),
+    session: AsyncSession = Depends(get_read_session)
+):
+    try:
+        user_ids = list(dict.fromkeys(int(part) for value in ids for part in value.split(",") if part.strip()))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids must be integers")
+    if not user_ids or len(user_ids) > MAX_AVATAR_BATCH:
+        raise HTTPException(status_code=400, detail=f"Between 1 and {MAX_AVATAR_BATCH} ids are allowed")
+
+    response = ORJSONResponse({"avatars": await User.get_avatars(session, user_ids)})
+    etag = make_etag(response.body)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return response
 
 #=============================================Listing related routes===========================================================================
 @app.post("/api/listing")
@@ -127,9 +179,9 @@ async def create_listing(
     description: str = Form(...,min_length=1,max_length=2000),
     price: float = Form(...,ge=0,le=1000000000),
     category:int=Form(...,ge=0),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
     user_id: int = Depends(auth_handler.auth_wrapper),
-    files: List[UploadFile] = Depends(validate_and_upload_files)
+    files: List[StoredBlob] = Depends(validate_and_upload_files)
 ):
     # Create ListingModel instance manually
     listing_model = ListingModel(title=title, description=description, price=price,category=category)
@@ -137,50 +189,104 @@ async def create_listing(
     # Convert ListingModel to Listing
     listing = Listing(**listing_model.model_dump())
 
-    # Create the listing and get the listing_id
-    listing_obj = Listing.create(user=user_id, listing=listing, session=session)
+    # Files are already stored by content hash, the listing just references them
+    image_paths = [blob.path for blob in files]
+
+    # Record the images with the listing so listing reads never have to scan the upload folder
+    listing_obj = await Listing.create(user=user_id, listing=listing, session=session, image_paths=image_paths)
     listing_id = listing_obj.id  # Assuming the created listing object has an id attribute
-    
-    # Directory where images will be saved
-    listing_upload_dir = os.path.join(UPLOAD_DIR, str(listing_id))
-    os.makedirs(listing_upload_dir, exist_ok=True)
-    
-    # Save each uploaded file with the specified format
-    image_urls = []
-    for i, file in enumerate(files):
-        file_extension = file.filename.split('.')[-1].lower()
-        file_path = os.path.join(listing_upload_dir, f"{i + 1}.{file_extension}")
-        
-        with open(file_path, "wb") as buffer:
-            buffer.write(await file.read())
-        
-        image_urls.append(f"/uploads/{listing_id}/{i + 1}.{file_extension}")
+    schedule_variants(image_paths, record_variants)
+    image_urls = [f"/{path}" for path in image_paths]
     
     return {"message": "Listing created successfully", "listing_id": listing_id, "image_urls": image_urls}
 
 
-@app.get("/api/listing/{listing_id}")
-async def get_listing(listing_id:int,session:Session=Depends(get_session)):
-    return Listing.get_single_listing(listing_id,session)
+# Listing routes return ORJSONResponse directly, skipping response validation and jsonable_encoder on plain dict rows
+@app.get("/api/listing/{listing_id}", response_class=ORJSONResponse)
+async def get_listing(listing_id:int,session: AsyncSession = Depends(get_read_session)):
+    return ORJSONResponse(await Listing.get_single_listing(listing_id,session))
 
 
-@app.get("/api/listings", response_model=List[dict])
+@app.get("/api/listings", response_model=Union[List[dict], dict], response_class=ORJSONResponse)
 async def get_listings(
     offset: int = Query(0, ge=0),
     limit: int = Query(100, ge=1),
     categories: Optional[List[int]] = Query(None),
     sort_order: Optional[str] = Query(None),
-    session: Session = Depends(get_session)
+    cursor: Optional[str] = Query(None),
+    price_min: Optional[float] = Query(None, ge=0),
+    price_max: Optional[float] = Query(None, ge=0),
+    session: AsyncSession = Depends(get_read_session)
 ):
-    listings = Listing.get_multiple_listings(session, offset, limit, categories, sort_order)
-    return listings
+    # Passing cursor (empty for the first page) switches to keyset pagination,
+    # which returns {"listings": [...], "next_cursor": ...} instead of a bare list
+    body = await Listing.get_rendered_page(session, offset, limit, categories, sort_order, cursor, price_min, price_max)
+    return Response(content=body, media_type="application/json")
 
-@app.get('/api/listings/user/{user_id}')
-async def get_all_user_listings(user_id:int,session:Session=Depends(get_session)):
-    return Listing.get_all_user_listings(session=session,user_id=user_id)
+@app.get("/api/listings/facets", response_class=ORJSONResponse)
+async def get_listing_facets(
+    categories: Optional[List[int]] = Query(None),
+    price_min: Optional[float] = Query(None, ge=0),
+    price_max: Optional[float] = Query(None, ge=0),
+    session: AsyncSession = Depends(get_read_session)
+):
+    # Category counts and a price histogram for a filter sidebar, from a single grouped query
+    return ORJSONResponse(await Listing.get_facets(session, categories, price_min, price_max))
+
+@app.get("/api/listings/search", response_class=ORJSONResponse)
+async def search_listings(
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(20, ge=1, le=100),
+    categories: Optional[List[int]] = Query(None),
+    sort_order: Optional[str] = Query(None),
+    cursor: Optional[str] = Query(None),
+    session: AsyncSession = Depends(get_read_session)
+):
+    return ORJSONResponse(await Listing.search(session, q, limit, categories, sort_order, cursor))
+
+@app.post("/api/listings/import", dependencies=[Depends(verify_admin_code)])
+async def import_listings(request: Request, session: AsyncSession = Depends(get_async_session)):
+    # Body is NDJSON, one {"title", "description", "price", "category", "user"} object per line, read as it streams in
+    return await import_listings_ndjson(session, request.stream())
+
+@app.get("/api/listings/export", dependencies=[Depends(verify_admin_code)])
+async def export_all_listings(format: str = Query("ndjson")):
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown export format {format}")
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        export_listings(format),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="listings.{format}"'},
+    )
+
+@app.get('/api/listings/user/{user_id}', response_class=ORJSONResponse)
+async def get_all_user_listings(user_id:int,session: AsyncSession = Depends(get_read_session)):
+    return ORJSONResponse(await Listing.get_all_user_listings(session=session,user_id=user_id))
 
 
 #=============================================Handling Messaging===========================================================
+@app.get("/api/conversations")
+async def get_conversations(
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = Query(None),
+    user_id: int = Depends(auth_handler.auth_wrapper),
+    session: AsyncSession = Depends(get_async_session)
+):
+    return await Conversation.get_inbox(session, user_id, limit, cursor)
+
+@app.get("/api/conversations/{conversation_id}/messages")
+async def get_conversation_messages(
+    conversation_id: int,
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = Query(None),
+    user_id: int = Depends(auth_handler.auth_wrapper),
+    session: AsyncSession = Depends(get_async_session)
+):
+    return await Conversation.get_messages(session, conversation_id, user_id, limit, cursor)
+
+
 @app.websocket("/ws/{token}")
-async def websocket_route(websocket: WebSocket, token: str, session: Session = Depends(get_session)):
-    await websocket_endpoint(websocket, token, session)
+async def websocket_route(websocket: WebSocket, token: str):
+    # Messages are written by the shared group-commit writer, so the socket does not hold a session of its own
+    await websocket_endpoint(websocket, token)
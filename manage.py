@@ -0,0 +1,154 @@
+import argparse
+import hashlib
+import multiprocessing
+import os
+import re
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+from sqlmodel import Session, select
+from sqlalchemy import func, update
+
+from database import engine, rebuild_search_index
+from db_schema import Category, Listing, ListingImage, User
+from images import IMAGE_WORKERS, VARIANT_KEY, generate_variants, is_variant
+from storage import PROFILE_DIR, UPLOAD_ROOT, StoredBlob, disk_path_for, sniff_image_type
+
+
+def _natural_key(filename: str):
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', filename)]
+
+
+def backfill_listing_images(args):
+    listings_dir = os.path.join(UPLOAD_ROOT, 'listings')
+    if not os.path.isdir(listings_dir):
+        print("No uploads/listings directory, nothing to backfill")
+        return
+
+    with Session(engine) as session:
+        listing_ids = set(session.exec(select(Listing.id)).all())
+        recorded = set(session.exec(select(ListingImage.listing_id).distinct()).all())
+        created = 0
+        for entry in sorted(os.listdir(listings_dir), key=_natural_key):
+            folder = os.path.join(listings_dir, entry)
+            if not entry.isdigit() or not os.path.isdir(folder):
+                continue
+            listing_id = int(entry)
+            if listing_id not in listing_ids:
+                print(f"Skipping uploads/listings/{entry}: listing does not exist")
+                continue
+            if listing_id in recorded:
+                continue
+            files = sorted(
+                (f for f in os.listdir(folder) if os.path.isfile(os.path.join(folder, f)) and not is_variant(f)),
+                key=_natural_key,
+            )
+            for position, filename in enumerate(files, start=1):
+                session.add(ListingImage(listing_id=listing_id, position=position, path=f"uploads/listings/{listing_id}/{filename}"))
+                created += 1
+        session.commit()
+    print(f"Backfilled {created} listing images")
+
+
+def backfill_avatars(args):
+    if not os.path.isdir(PROFILE_DIR):
+        print("No uploads/profiles directory, nothing to backfill")
+        return
+
+    with Session(engine) as session:
+        users = {user.id: user for user in session.exec(select(User).where(User.avatar_path.is_(None))).all()}
+        updated = 0
+        for entry in sorted(os.listdir(PROFILE_DIR), key=_natural_key):
+            folder = os.path.join(PROFILE_DIR, entry)
+            if not entry.isdigit() or int(entry) not in users or not os.path.isdir(folder):
+                continue
+            files = [os.path.join(folder, f) for f in sorted(os.listdir(folder)) if os.path.isfile(os.path.join(folder, f)) and not is_variant(f)]
+            if not files:
+                continue
+            with open(files[0], "rb") as avatar:
+                data = avatar.read()
+            extension = sniff_image_type(data)
+            if extension is None:
+                print(f"Skipping {files[0]}: not a png or jpg")
+                continue
+            # Older avatars were written straight into the profile folder, so move them into the blob store
+            blob = StoredBlob(sha256=hashlib.sha256(data).hexdigest(), extension=extension, size=len(data))
+            if not os.path.exists(blob.disk_path):
+                os.makedirs(os.path.dirname(blob.disk_path), exist_ok=True)
+                shutil.copyfile(files[0], blob.disk_path)
+            users[int(entry)].avatar_path = blob.path
+            session.add(users[int(entry)])
+            updated += 1
+        session.commit()
+    print(f"Recorded avatars for {updated} users")
+
+
+def rebuild_search(args):
+    with engine.begin() as connection:
+        indexed = rebuild_search_index(connection)
+    print(f"Indexed {indexed} listings for search")
+
+
+def regenerate_variants(args):
+    with Session(engine) as session:
+        paths = set(session.exec(select(ListingImage.path)).all())
+        paths.update(session.exec(select(User.avatar_path).where(User.avatar_path.is_not(None))).all())
+
+    paths = sorted(path for path in paths if os.path.isfile(disk_path_for(path)))
+    written = 0
+    ready = []
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = {path: executor.submit(generate_variants, disk_path_for(path)) for path in paths}
+        for path, future in futures.items():
+            try:
+                written += len(future.result())
+                ready.append(path)
+            except Exception as e:
+                print(f"Failed to generate variants for {path}: {e}")
+
+    # Only images recorded here are served with variant URLs
+    with Session(engine) as session:
+        for start in range(0, len(ready), 500):
+            chunk = ready[start:start + 500]
+            session.exec(update(ListingImage).where(ListingImage.path.in_(chunk)).values(variants_key=VARIANT_KEY))
+            session.exec(update(User).where(User.avatar_path.in_(chunk)).values(avatar_variants_key=VARIANT_KEY))
+        session.commit()
+    print(f"Wrote {written} variants for {len(paths)} images")
+
+
+def reconcile_category_counts(args):
+    listing_count = (
+        select(func.count(Listing.id)).where(Listing.category == Category.id).scalar_subquery()
+    )
+    with Session(engine) as session:
+        result = session.exec(update(Category).values(item_count=listing_count))
+        session.commit()
+    print(f"Recomputed item_count for {result.rowcount} categories")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintenance commands for the Eagle Thrift backend")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    backfill = subparsers.add_parser("backfill-images", help="Record existing uploads/listings files in the listingimage table")
+    backfill.set_defaults(func=backfill_listing_images)
+
+    avatars = subparsers.add_parser("backfill-avatars", help="Record existing uploads/profiles images in user.avatar_path")
+    avatars.set_defaults(func=backfill_avatars)
+
+    search = subparsers.add_parser("rebuild-search", help="Rebuild the listing_fts full-text index from the listing table")
+    search.set_defaults(func=rebuild_search)
+
+    variants = subparsers.add_parser("regenerate-variants", help="Generate thumbnail and medium variants for every listing image and avatar, and mark them servable")
+    variants.add_argument("--workers", type=int, default=IMAGE_WORKERS)
+    variants.set_defaults(func=regenerate_variants)
+
+    counts = subparsers.add_parser("reconcile-category-counts", help="Recompute category.item_count from the listing table")
+    counts.set_defaults(func=reconcile_category_counts)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
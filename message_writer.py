@@ -0,0 +1,88 @@
+import asyncio
+import logging
+from typing import List, Optional
+
+from fastapi import HTTPException
+from dotenv import dotenv_values
+
+from database import async_session_maker
+from db_schema import Message
+
+config = dotenv_values('.env')
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_BATCH_SIZE = int(config.get("MESSAGE_BATCH_SIZE") or 256)
+MESSAGE_BATCH_INTERVAL = float(config.get("MESSAGE_BATCH_INTERVAL_MS") or 5) / 1000
+
+
+class MessageWriter:
+    """Group-commits chat messages: one transaction per batch, flushed every few ms or every N messages.
+
+    A single writer task drains the queue in arrival order, so per-conversation order is preserved,
+    and submit() only returns once the batch holding the message has committed.
+    """
+
+    def __init__(self, batch_size: int = MESSAGE_BATCH_SIZE, interval: float = MESSAGE_BATCH_INTERVAL):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue: Optional[asyncio.Queue] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def ensure_started(self):
+        if self.task is None or self.task.done():
+            self.queue = asyncio.Queue(maxsize=self.batch_size * 16)
+            self.task = asyncio.create_task(self.run())
+
+    async def submit(self, listing_id: int, sender_id: int, content: str) -> Message:
+        self.ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((listing_id, sender_id, content, future))
+        return await future
+
+    async def run(self):
+        while True:
+            batch = [await self.queue.get()]
+            if self.queue.qsize() < self.batch_size - 1:
+                # Give concurrent senders a moment to join this commit
+                await asyncio.sleep(self.interval)
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            try:
+                await self.flush(batch)
+            except Exception:
+                logger.exception("Message batch failed")
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(HTTPException(status_code=500, detail="Could not store message"))
+
+    async def write(self, requests) -> List:
+        async with async_session_maker() as session:
+            return await Message.create_messages(session, requests)
+
+    async def flush(self, batch):
+        requests = [(listing_id, sender_id, content) for listing_id, sender_id, content, _ in batch]
+        try:
+            results = await self.write(requests)
+        except Exception:
+            if len(requests) == 1:
+                raise
+            # Isolate the failing message instead of failing everyone who shared its batch
+            results = []
+            for request in requests:
+                try:
+                    results.extend(await self.write([request]))
+                except Exception as e:
+                    logger.error("Could not store message: %s", e)
+                    results.append(HTTPException(status_code=500, detail="Could not store message"))
+
+        for (*_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+message_writer = MessageWriter()
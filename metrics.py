@@ -0,0 +1,261 @@
+import logging
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+from dotenv import dotenv_values
+
+config = dotenv_values('.env')
+
+# Requests issuing more queries than this are logged, which is how N+1 loops show up
+METRICS_QUERY_LOG_THRESHOLD = int(config.get("METRICS_QUERY_LOG_THRESHOLD") or 20)
+METRICS_SERVER_TIMING = (config.get("METRICS_SERVER_TIMING") or "false").lower() in ("1", "true", "yes")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 250)
+
+logger = logging.getLogger(__name__)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> Iterable[Tuple[str, str, float]]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{name}{labels} {_format_value(value)}" for name, labels, value in self.samples())
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, _format_labels(self.labelnames, key), value
+
+
+class Gauge(Metric):
+    """A gauge that is either set directly or read from a callback at scrape time."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values: Dict[LabelValues, float] = {}
+        self.functions: Dict[LabelValues, Callable[[], float]] = {}
+
+    def set(self, value: float, **labels):
+        self.values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function: Callable[[], float], **labels):
+        self.functions[self._key(labels)] = function
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, _format_labels(self.labelnames, key), value
+        for key, function in self.functions.items():
+            yield self.name, _format_labels(self.labelnames, key), function()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per-bucket counts..., +Inf count, sum]
+        self.values: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self.values.get(key)
+        if series is None:
+            series = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def samples(self):
+        for key, series in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                yield f"{self.name}_bucket", _format_labels(self.labelnames, key, ("le", _format_value(bound))), cumulative
+            yield f"{self.name}_count", _format_labels(self.labelnames, key), cumulative
+            yield f"{self.name}_sum", _format_labels(self.labelnames, key), series[-1]
+
+
+registry: List[Metric] = []
+
+
+def register(metric: Metric) -> Metric:
+    registry.append(metric)
+    return metric
+
+
+def render_metrics() -> str:
+    return "\n".join(line for metric in registry for line in metric.render()) + "\n"
+
+
+http_request_duration = register(Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route template", ("method", "route", "status")))
+http_requests_in_flight = register(Gauge("http_requests_in_flight", "HTTP requests currently being served"))
+http_request_queries = register(Histogram(
+    "http_request_db_queries", "SQL statements issued per HTTP request", ("method", "route"), QUERY_COUNT_BUCKETS))
+http_request_query_duration = register(Histogram(
+    "http_request_db_query_duration_seconds", "Time spent in SQL per HTTP request", ("method", "route")))
+db_queries = register(Counter("db_queries_total", "SQL statements executed, inside or outside a request"))
+db_query_duration = register(Counter("db_query_duration_seconds_total", "Time spent executing SQL statements"))
+websocket_connections = register(Gauge("websocket_connections", "Open websocket connections"))
+websocket_users = register(Gauge("websocket_connected_users", "Users with at least one open websocket"))
+websocket_messages = register(Counter(
+    "websocket_messages_total", "Chat messages received from and delivered to websockets; use rate() for messages per second",
+    ("direction",)))
+websocket_dropped_frames = register(Counter(
+    "websocket_dropped_frames_total", "Frames discarded from full send queues under the coalesce policy", ("type",)))
+websocket_send_queue_depth = register(Gauge(
+    "websocket_send_queue_depth", "Frames waiting in websocket send queues", ("aggregate",)))
+cache_hit_ratio = register(Gauge("cache_hit_ratio", "Hit ratio of in-process caches since start", ("cache",)))
+cache_entries = register(Gauge("cache_entries", "Entries held by in-process caches", ("cache",)))
+
+
+def watch_cache(name: str, cache):
+    cache_hit_ratio.set_function(lambda: cache.hit_ratio, cache=name)
+    cache_entries.set_function(lambda: len(cache), cache=name)
+
+
+@dataclass
+class RequestStats:
+    queries: int = 0
+    query_seconds: float = 0.0
+
+
+# Set by MetricsMiddleware for the duration of a request; SQL hooks add to it, including from the async driver's greenlet
+current_request_stats: ContextVar[Optional[RequestStats]] = ContextVar("current_request_stats", default=None)
+
+
+def instrument_engine(engine):
+    @event.listens_for(engine, "before_cursor_execute")
+    def start_query_timer(connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def stop_query_timer(connection, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - connection.info["query_start_time"].pop()
+        db_queries.inc()
+        db_query_duration.inc(elapsed)
+        stats = current_request_stats.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.query_seconds += elapsed
+
+    @event.listens_for(engine, "handle_error")
+    def discard_query_timer(exception_context):
+        # after_cursor_execute never fires for a failed statement
+        connection = exception_context.connection
+        if connection is not None and connection.info.get("query_start_time"):
+            connection.info["query_start_time"].pop()
+
+
+def route_label(scope, root_path: str) -> str:
+    # Route templates keep the label set bounded; raw paths would create a series per listing id
+    route = scope.get("route")
+    if route is not None and hasattr(route, "path"):
+        return route.path
+    mounted = scope.get("root_path", "")
+    if mounted != root_path:
+        return mounted[len(root_path):] + "/{path}"
+    return "unmatched"
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware, so streaming responses pass through untouched and the timing covers the whole stack."""
+
+    def __init__(self, app, server_timing: bool = METRICS_SERVER_TIMING):
+        self.app = app
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        root_path = scope.get("root_path", "")
+        stats = RequestStats()
+        token = current_request_stats.set(stats)
+        status_code = 500
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if self.server_timing:
+                    elapsed_ms = (time.perf_counter() - start) * 1000
+                    value = f'db;dur={stats.query_seconds * 1000:.1f};desc="{stats.queries} queries", app;dur={elapsed_ms:.1f}'
+                    message["headers"] = list(message.get("headers", [])) + [(b"server-timing", value.encode("latin-1"))]
+            await send(message)
+
+        http_requests_in_flight.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            http_requests_in_flight.dec()
+            current_request_stats.reset(token)
+            elapsed = time.perf_counter() - start
+            method = scope["method"]
+            route = route_label(scope, root_path)
+            http_request_duration.observe(elapsed, method=method, route=route, status=str(status_code))
+            http_request_queries.observe(stats.queries, method=method, route=route)
+            http_request_query_duration.observe(stats.query_seconds, method=method, route=route)
+            if stats.queries > METRICS_QUERY_LOG_THRESHOLD:
+                logger.warning(
+                    "%s %s issued %d SQL queries (%.1f ms), threshold is %d",
+                    method, scope["path"], stats.queries, stats.query_seconds * 1000, METRICS_QUERY_LOG_THRESHOLD,
+                )
@@ -0,0 +1,123 @@
+import os
+import re
+import typing
+
+import anyio
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+from starlette.types import Receive, Scope, Send
+
+from http_cache import etag_matches
+from images import VARIANT_SUFFIX
+
+# Blob names are content hashes, and variant names add their rendering parameters, so the bytes under a URL never change
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Legacy paths and unversioned variants (<sha>_thumb.webp) can be rewritten, so clients must revalidate
+REVALIDATE_CACHE_CONTROL = "public, no-cache"
+
+IMMUTABLE_NAME_PATTERN = re.compile(rf"^[0-9a-f]{{64}}(?:{VARIANT_SUFFIX})?$")
+
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def parse_range(range_header: str, size: int) -> typing.Optional[typing.Tuple[int, int]]:
+    """Return an inclusive (start, end) for a single byte range, or None if it cannot be satisfied.
+
+    Multi-range requests raise ValueError so the caller can fall back to the full body.
+    """
+    match = RANGE_PATTERN.match(range_header.strip())
+    if not match:
+        raise ValueError("Unsupported range")
+    start, end = match.groups()
+    if not start and not end:
+        raise ValueError("Unsupported range")
+    if not start:
+        length = int(end)
+        if length == 0:
+            return None
+        return max(size - length, 0), size - 1
+    start = int(start)
+    end = int(end) if end else size - 1
+    if start >= size or end < start:
+        return None
+    return start, min(end, size - 1)
+
+
+class UploadFileResponse(FileResponse):
+    """FileResponse with single byte-range support and zero-copy sends when the server offers them."""
+
+    def __init__(self, *args, byte_range: typing.Optional[typing.Tuple[int, int]] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.byte_range = byte_range
+        self.headers["accept-ranges"] = "bytes"
+        if byte_range is not None:
+            start, end = byte_range
+            self.status_code = 206
+            self.headers["content-range"] = f"bytes {start}-{end}/{self.stat_result.st_size}"
+            self.headers["content-length"] = str(end - start + 1)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        size = self.stat_result.st_size
+        start, end = self.byte_range if self.byte_range is not None else (0, size - 1)
+        count = end - start + 1
+        extensions = scope.get("extensions") or {}
+
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if scope["method"].upper() == "HEAD" or size == 0:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        elif "http.response.zerocopysend" in extensions:
+            # The server sendfile()s straight from our descriptor
+            with open(self.path, "rb") as file:
+                await send({"type": "http.response.zerocopysend", "file": file, "offset": start, "count": count})
+        elif "http.response.pathsend" in extensions and self.byte_range is None:
+            await send({"type": "http.response.pathsend", "path": str(self.path)})
+        else:
+            async with await anyio.open_file(self.path, mode="rb") as file:
+                await file.seek(start)
+                remaining = count
+                while remaining > 0:
+                    chunk = await file.read(min(self.chunk_size, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+                if remaining > 0:
+                    await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+class UploadFiles(StaticFiles):
+    def file_response(self, full_path, stat_result: os.stat_result, scope: Scope, status_code: int = 200) -> Response:
+        request_headers = Headers(scope=scope)
+        relative_path = os.path.relpath(full_path, self.directory).replace(os.sep, "/")
+
+        headers = {"cache-control": REVALIDATE_CACHE_CONTROL}
+        name = os.path.splitext(os.path.basename(relative_path))[0]
+        if relative_path.startswith("blobs/") and IMMUTABLE_NAME_PATTERN.match(name):
+            # Strong ETag from the immutable name, which every worker and node agrees on
+            headers["etag"] = f'"{name}"'
+            headers["cache-control"] = IMMUTABLE_CACHE_CONTROL
+
+        response = UploadFileResponse(full_path, status_code=status_code, stat_result=stat_result, headers=headers)
+        if status_code == 200 and self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+
+        range_header = request_headers.get("range")
+        if status_code != 200 or not range_header:
+            return response
+        if_range = request_headers.get("if-range")
+        if if_range and not etag_matches(if_range, response.headers["etag"]):
+            # The client's partial copy is stale, send the whole file
+            return response
+        try:
+            byte_range = parse_range(range_header, stat_result.st_size)
+        except ValueError:
+            return response
+        if byte_range is None:
+            return Response(
+                status_code=416,
+                headers={"content-range": f"bytes */{stat_result.st_size}", "cache-control": headers["cache-control"]},
+            )
+        return UploadFileResponse(
+            full_path, status_code=status_code, stat_result=stat_result, headers=headers, byte_range=byte_range
+        )
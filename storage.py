@@ -0,0 +1,121 @@
+import hashlib
+import os
+import tempfile
+from dataclasses import dataclass
+from typing import Optional
+
+from fastapi import HTTPException, UploadFile
+from starlette.concurrency import run_in_threadpool
+from dotenv import dotenv_values
+
+config = dotenv_values('.env')
+
+UPLOAD_ROOT = config.get("UPLOAD_ROOT") or os.path.join(os.path.dirname(__file__), 'uploads')
+BLOB_DIR = os.path.join(UPLOAD_ROOT, 'blobs')
+# Per-user avatar copies from before user.avatar_path; only read by manage.py backfill-avatars
+PROFILE_DIR = os.path.join(UPLOAD_ROOT, 'profiles')
+# Kept next to (not inside) the served uploads tree so partial files are never reachable and renames stay atomic
+UPLOAD_TMP_DIR = config.get("UPLOAD_TMP_DIR") or os.path.join(os.path.dirname(os.path.abspath(UPLOAD_ROOT)), '.upload_tmp')
+
+MAX_FILE_SIZE = 5 * 1024 * 1024  # 5MB
+CHUNK_SIZE = 64 * 1024
+
+# Leading bytes of every accepted image type; the stored extension comes from here, never from the client
+IMAGE_SIGNATURES = {
+    b"\x89PNG\r\n\x1a\n": "png",
+    b"\xff\xd8\xff": "jpg",
+}
+
+
+@dataclass
+class StoredBlob:
+    sha256: str
+    extension: str
+    size: int
+    filename: Optional[str] = None
+
+    @property
+    def name(self) -> str:
+        return f"{self.sha256}.{self.extension}"
+
+    @property
+    def relative_dir(self) -> str:
+        return f"blobs/{self.sha256[:2]}/{self.sha256[2:4]}"
+
+    @property
+    def path(self) -> str:
+        # Path as served by the /uploads mount, e.g. uploads/blobs/ab/cd/abcd....jpg
+        return f"uploads/{self.relative_dir}/{self.name}"
+
+    @property
+    def disk_path(self) -> str:
+        return os.path.join(UPLOAD_ROOT, self.relative_dir, self.name)
+
+
+def disk_path_for(path: str) -> str:
+    # Map a served path such as uploads/blobs/ab/cd/<sha>.jpg onto UPLOAD_ROOT
+    relative = path[len("uploads/"):] if path.startswith("uploads/") else path
+    return os.path.join(UPLOAD_ROOT, *relative.split("/"))
+
+
+def sniff_image_type(header: bytes) -> Optional[str]:
+    for signature, extension in IMAGE_SIGNATURES.items():
+        if header.startswith(signature):
+            return extension
+    return None
+
+
+def _open_temp_file():
+    os.makedirs(UPLOAD_TMP_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=UPLOAD_TMP_DIR, suffix=".part")
+    return os.fdopen(fd, "wb"), tmp_path
+
+
+def _write_chunk(buffer, digest, chunk: bytes):
+    digest.update(chunk)
+    buffer.write(chunk)
+
+
+def _commit_blob(tmp_path: str, disk_path: str):
+    os.makedirs(os.path.dirname(disk_path), exist_ok=True)
+    if os.path.exists(disk_path):
+        # Same content already stored, keep the existing blob
+        os.remove(tmp_path)
+    else:
+        os.replace(tmp_path, disk_path)
+
+
+def _discard(tmp_path: str):
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+
+async def store_upload(upload: UploadFile) -> StoredBlob:
+    buffer, tmp_path = await run_in_threadpool(_open_temp_file)
+    digest = hashlib.sha256()
+    size = 0
+    extension = None
+    try:
+        try:
+            while True:
+                chunk = await upload.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                if extension is None:
+                    extension = sniff_image_type(chunk)
+                    if extension is None:
+                        raise HTTPException(status_code=400, detail=f"File {upload.filename} is not an allowed image type (png, jpg, jpeg)")
+                size += len(chunk)
+                if size > MAX_FILE_SIZE:
+                    raise HTTPException(status_code=400, detail=f"File {upload.filename} exceeds the maximum size of 5MB")
+                await run_in_threadpool(_write_chunk, buffer, digest, chunk)
+        finally:
+            await run_in_threadpool(buffer.close)
+        if size == 0:
+            raise HTTPException(status_code=400, detail=f"File {upload.filename} is empty")
+
+        blob = StoredBlob(sha256=digest.hexdigest(), extension=extension, size=size, filename=upload.filename)
+        await run_in_threadpool(_commit_blob, tmp_path, blob.disk_path)
+        return blob
+    finally:
+        await run_in_threadpool(_discard, tmp_path)
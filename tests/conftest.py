@@ -0,0 +1,9 @@
+import os
+import tempfile
+
+
+def pytest_sessionstart(session):
+    # Modules read .env and open ./api.db relative to the working directory, so tests run in a scratch directory
+    os.chdir(tempfile.mkdtemp(prefix="eagle-thrift-tests-"))
+    with open(".env", "w") as env:
+        env.write("SECRET=test-secret\nADMIN_CODE=test-admin\nUPLOAD_ROOT=./uploads\n")
@@ -0,0 +1,86 @@
+import asyncio
+import multiprocessing
+
+from broker import SQLiteOutboxBroker
+
+FRAMES = 50
+POLL_INTERVAL = 0.01
+
+
+def run_subscriber(path, ready, results):
+    async def main():
+        received = []
+
+        async def handler(user_id, payload):
+            received.append(payload["n"])
+
+        broker = SQLiteOutboxBroker(handler, path=path, poll_interval=POLL_INTERVAL)
+        # Several websockets connecting at once each call start()
+        await asyncio.gather(*(broker.start() for _ in range(5)))
+        ready.set()
+        for _ in range(1000):
+            if len(received) >= FRAMES:
+                break
+            await asyncio.sleep(POLL_INTERVAL)
+        # Leave time for any duplicate copies to arrive
+        await asyncio.sleep(POLL_INTERVAL * 20)
+        await broker.stop()
+        results.put(received)
+
+    asyncio.run(main())
+
+
+def publish_frames(path, count):
+    async def main():
+        async def handler(user_id, payload):
+            pass
+
+        broker = SQLiteOutboxBroker(handler, path=path)
+        for n in range(count):
+            await broker.publish(1, {"n": n})
+
+    asyncio.run(main())
+
+
+def test_each_worker_receives_every_frame_once(tmp_path):
+    path = str(tmp_path / "outbox.db")
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    workers = []
+    for _ in range(3):
+        ready = context.Event()
+        process = context.Process(target=run_subscriber, args=(path, ready, results))
+        process.start()
+        workers.append((process, ready))
+    for process, ready in workers:
+        assert ready.wait(30)
+
+    publish_frames(path, FRAMES)
+
+    received = [results.get(timeout=30) for _ in workers]
+    for process, _ in workers:
+        process.join(10)
+        assert process.exitcode == 0
+    for frames in received:
+        assert frames == list(range(FRAMES))
+
+
+def test_stop_ends_delivery_after_concurrent_starts(tmp_path):
+    path = str(tmp_path / "outbox.db")
+
+    async def main():
+        received = []
+
+        async def handler(user_id, payload):
+            received.append(payload["n"])
+
+        broker = SQLiteOutboxBroker(handler, path=path, poll_interval=POLL_INTERVAL)
+        await asyncio.gather(broker.start(), broker.start(), broker.start())
+        await broker.publish(1, {"n": 0})
+        await asyncio.sleep(POLL_INTERVAL * 20)
+        await broker.stop()
+        await broker.publish(1, {"n": 1})
+        await asyncio.sleep(POLL_INTERVAL * 20)
+        return received
+
+    assert asyncio.run(main()) == [0]
@@ -0,0 +1,69 @@
+import asyncio
+import sqlite3
+
+from sqlalchemy import text
+
+import database
+from database import ReplicaSet
+
+
+def make_replica(path, name):
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE marker (name TEXT)")
+    connection.execute("INSERT INTO marker VALUES (?)", (name,))
+    connection.commit()
+    connection.close()
+
+
+async def served_by(replicas):
+    session = await replicas.session()
+    if session is None:
+        return None
+    async with session:
+        return (await session.execute(text("SELECT name FROM marker"))).scalar_one()
+
+
+def test_replicas_round_robin_skip_failures_and_rejoin(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_REPLICA_RETRY_SECONDS", 0.2)
+    make_replica(tmp_path / "a.db", "a")
+    # The second replica's directory does not exist yet, so connecting to it fails
+    missing_dir = tmp_path / "offline"
+    replicas = ReplicaSet([f"sqlite:///{tmp_path / 'a.db'}", f"sqlite:///{missing_dir / 'b.db'}"])
+
+    async def main():
+        try:
+            assert [await served_by(replicas) for _ in range(4)] == ["a", "a", "a", "a"]
+            assert replicas.replicas[1].down_until > 0
+
+            missing_dir.mkdir()
+            make_replica(missing_dir / "b.db", "b")
+            # Still inside the retry window, so the replica is not tried again yet
+            assert [await served_by(replicas) for _ in range(2)] == ["a", "a"]
+
+            await asyncio.sleep(0.3)
+            assert sorted([await served_by(replicas) for _ in range(4)]) == ["a", "a", "b", "b"]
+            assert replicas.replicas[1].down_until == 0.0
+        finally:
+            for replica in replicas.replicas:
+                await replica.engine.dispose()
+
+    asyncio.run(main())
+
+
+def test_reads_fall_back_to_primary_without_healthy_replica(tmp_path, monkeypatch):
+    replicas = ReplicaSet([f"sqlite:///{tmp_path / 'offline' / 'a.db'}"])
+    monkeypatch.setattr(database, "read_replicas", replicas)
+
+    async def main():
+        try:
+            sessions = database.get_read_session()
+            session = await sessions.__anext__()
+            assert session.bind is database.async_engine
+            await sessions.aclose()
+        finally:
+            # Lets aiosqlite's thread for the failed connection finish before the loop closes
+            await asyncio.sleep(0.1)
+            await replicas.replicas[0].engine.dispose()
+            await database.async_engine.dispose()
+
+    asyncio.run(main())
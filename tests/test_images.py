@@ -0,0 +1,40 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+import images
+
+
+def run_schedule(paths):
+    async def main():
+        ready = []
+
+        async def on_ready(paths):
+            ready.extend(paths)
+
+        images.schedule_variants(paths, on_ready)
+        await asyncio.gather(*images._pending)
+        return ready
+
+    return asyncio.run(main())
+
+
+def test_only_generated_images_are_reported_ready(tmp_path, monkeypatch):
+    monkeypatch.setattr(images, "disk_path_for", lambda path: str(tmp_path / path))
+    monkeypatch.setattr(images, "get_executor", lambda: ThreadPoolExecutor(max_workers=1))
+    Image.new("RGB", (40, 30), "red").save(tmp_path / "good.png")
+    (tmp_path / "broken.png").write_bytes(b"not an image")
+
+    assert run_schedule(["good.png", "broken.png"]) == ["good.png"]
+    for target in images.variant_paths(str(tmp_path / "good.png")).values():
+        assert Image.open(target).size[0] > 0
+
+
+def test_unavailable_pool_is_logged_not_raised(monkeypatch, caplog):
+    def broken_executor():
+        raise RuntimeError("pool is broken")
+
+    monkeypatch.setattr(images, "get_executor", broken_executor)
+    assert run_schedule(["a.png"]) == []
+    assert "pool is broken" in caplog.text
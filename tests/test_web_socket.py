@@ -0,0 +1,72 @@
+import asyncio
+
+import web_socket
+from metrics import websocket_dropped_frames
+from web_socket import ClientConnection
+
+
+def make_connection(size):
+    connection = ClientConnection(websocket=None, user_id=1)
+    connection.queue = asyncio.Queue(maxsize=size)
+    return connection
+
+
+def queued_types(connection):
+    frames = [connection.queue.get_nowait() for _ in range(connection.queue.qsize())]
+    return [frame["type"] for frame in frames]
+
+
+def test_drop_policy_refuses_frames_when_full(monkeypatch):
+    monkeypatch.setattr(web_socket, "WS_SLOW_CONSUMER_POLICY", "drop")
+    connection = make_connection(1)
+    assert connection.enqueue({"type": "message", "id": 1})
+    assert not connection.enqueue({"type": "message", "id": 2})
+
+
+def test_coalesce_discards_pings_before_chat_frames(monkeypatch):
+    monkeypatch.setattr(web_socket, "WS_SLOW_CONSUMER_POLICY", "coalesce")
+    connection = make_connection(3)
+    for payload in ({"type": "ping"}, {"type": "message", "id": 1}, {"type": "message", "id": 2}):
+        assert connection.enqueue(payload)
+    assert connection.enqueue({"type": "message", "id": 3})
+    assert queued_types(connection) == ["message", "message", "message"]
+
+
+def test_coalesce_replaces_chat_frames_with_gap_notice(monkeypatch):
+    monkeypatch.setattr(web_socket, "WS_SLOW_CONSUMER_POLICY", "coalesce")
+    dropped_before = websocket_dropped_frames.values.get(("chat",), 0)
+    connection = make_connection(3)
+    for payload in ({"type": "ack", "acked_id": 4}, {"type": "message", "id": 5}, {"type": "backlog", "messages": []}):
+        assert connection.enqueue(payload)
+    assert connection.enqueue({"type": "message", "id": 6})
+    assert queued_types(connection) == ["ack", "gap"]
+    assert websocket_dropped_frames.values[("chat",)] - dropped_before == 3
+
+    # Further chat frames queue behind the notice until the queue fills again
+    assert connection.enqueue({"type": "message", "id": 7})
+    assert connection.enqueue({"type": "message", "id": 8})
+    assert connection.enqueue({"type": "message", "id": 9})
+    assert connection.queue.qsize() == 3
+
+
+def test_slow_consumer_eviction_task_is_held_until_done(monkeypatch):
+    monkeypatch.setattr(web_socket, "WS_SLOW_CONSUMER_POLICY", "drop")
+
+    async def main():
+        manager = web_socket.ConnectionManager()
+        connection = make_connection(1)
+        manager.active_connections[1] = {connection}
+        evicted = asyncio.Event()
+
+        async def evict(connection, reason):
+            evicted.set()
+
+        manager.evict = evict
+        manager.deliver(1, {"type": "message", "id": 1})
+        manager.deliver(1, {"type": "message", "id": 2})
+        assert len(manager.eviction_tasks) == 1
+        await asyncio.wait_for(evicted.wait(), 1)
+        await asyncio.sleep(0)
+        assert not manager.eviction_tasks
+
+    asyncio.run(main())
@@ -1,63 +1,255 @@
 # websocket_manager.py
-from fastapi import WebSocket, WebSocketDisconnect, HTTPException, Depends
-from typing import Dict
-from sqlmodel import Session
-from db_schema import Listing, Message,Conversation  # Ensure these are imported correctly
+import asyncio
+import time
+from fastapi import WebSocket, WebSocketDisconnect, HTTPException
+from typing import Dict, Optional, Set
 from auth import Authhandler  # Ensure your auth handler is imported correctly
+from broker import create_broker
+from message_writer import message_writer
+from database import async_session_maker
+from db_schema import DeliveryCursor, Message
+from metrics import (
+    websocket_connections, websocket_dropped_frames, websocket_messages, websocket_send_queue_depth, websocket_users,
+)
+from dotenv import dotenv_values
+
+config = dotenv_values('.env')
+
+# When enabled, messages are attributed to the user authenticated at connect time and the per-message token is ignored
+WS_TRUST_CONNECT_IDENTITY = (config.get("WS_TRUST_CONNECT_IDENTITY") or "false").lower() in ("1", "true", "yes")
+WS_SEND_QUEUE_SIZE = int(config.get("WS_SEND_QUEUE_SIZE") or 100)
+# "drop" disconnects a consumer whose queue is full. "coalesce" keeps it connected: queued pings are discarded first,
+# then queued chat frames are replaced by one {"type": "gap"} notice, after which the client sends {"type": "resync"}
+# to have everything after its ack cursor replayed
+WS_SLOW_CONSUMER_POLICY = (config.get("WS_SLOW_CONSUMER_POLICY") or "drop").lower()
+WS_HEARTBEAT_INTERVAL = float(config.get("WS_HEARTBEAT_INTERVAL") or 20)
+# Seconds without any client frame (e.g. {"type": "pong"}) before eviction; 0 leaves liveness to the server's
+# protocol-level pings (uvicorn --ws-ping-interval/--ws-ping-timeout), so listen-only clients stay connected
+WS_HEARTBEAT_TIMEOUT = float(config.get("WS_HEARTBEAT_TIMEOUT") or 0)
+WS_BACKLOG_BATCH_SIZE = int(config.get("WS_BACKLOG_BATCH_SIZE") or 100)
 
 auth_handler = Authhandler()
 
+
+class ClientConnection:
+    """One socket of a user, with its own bounded outbound queue drained by a dedicated writer task."""
+
+    def __init__(self, websocket: WebSocket, user_id: int):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=WS_SEND_QUEUE_SIZE)
+        self.last_seen = time.monotonic()
+        self.closed = False
+        self.writer: Optional[asyncio.Task] = None
+        self.backlog: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.writer = asyncio.create_task(self.write_loop())
+
+    async def write_loop(self):
+        try:
+            while True:
+                payload = await self.queue.get()
+                await self.websocket.send_json(payload)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # The socket is gone; the receive loop or heartbeat will clean up
+            self.closed = True
+
+    def enqueue(self, payload: dict) -> bool:
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(payload)
+            return True
+        except asyncio.QueueFull:
+            if WS_SLOW_CONSUMER_POLICY != "coalesce":
+                return False
+            return self.coalesce(payload)
+
+    def coalesce(self, payload: dict) -> bool:
+        frames = [self.queue.get_nowait() for _ in range(self.queue.qsize())] + [payload]
+        kept = [frame for frame in frames if frame.get("type") != "ping"]
+        websocket_dropped_frames.inc(len(frames) - len(kept), type="ping")
+        if len(kept) > self.queue.maxsize:
+            # Dropped chat frames are all committed, so a replay from the ack cursor recovers them
+            chat_types = ("message", "backlog", "gap")
+            dropped = sum(1 for frame in kept if frame.get("type") in ("message", "backlog"))
+            kept = [frame for frame in kept if frame.get("type") not in chat_types] + [{"type": "gap"}]
+            websocket_dropped_frames.inc(dropped, type="chat")
+        if len(kept) > self.queue.maxsize:
+            return False
+        for frame in kept:
+            self.queue.put_nowait(frame)
+        return True
+
+    async def put(self, payload: dict):
+        # Waits for queue space instead of applying the slow consumer policy; used for backlog replay
+        await self.queue.put(payload)
+
+    async def close(self, code: int = 1000, reason: str = ""):
+        if self.backlog:
+            self.backlog.cancel()
+        if self.writer:
+            self.writer.cancel()
+        if not self.closed:
+            self.closed = True
+            try:
+                await self.websocket.close(code=code, reason=reason)
+            except Exception:
+                pass
+
+
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: Dict[int, WebSocket] = {}
-        self.message_pipeline = []
+        self.active_connections: Dict[int, Set[ClientConnection]] = {}
+        self.heartbeat_task: Optional[asyncio.Task] = None
+        # The event loop only keeps weak references to tasks, so fire-and-forget evictions are held here until done
+        self.eviction_tasks: Set[asyncio.Task] = set()
+        # Every frame goes through the broker so receivers connected to other workers get it too
+        self.broker = create_broker(self.on_broker_message)
+        websocket_connections.set_function(lambda: sum(len(connections) for connections in self.active_connections.values()))
+        websocket_users.set_function(lambda: len(self.active_connections))
+        websocket_send_queue_depth.set_function(lambda: sum(self.queue_depths(), 0), aggregate="sum")
+        websocket_send_queue_depth.set_function(lambda: max(self.queue_depths(), default=0), aggregate="max")
+
+    def queue_depths(self):
+        return [connection.queue.qsize() for connections in self.active_connections.values() for connection in connections]
+
+    async def on_broker_message(self, user_id: int, payload: dict):
+        self.deliver(user_id, payload)
 
-    async def connect(self, websocket: WebSocket, user_id: int) -> bool:
+    async def connect(self, websocket: WebSocket, user_id: int) -> ClientConnection:
+        await self.broker.start()
+        # The cursor exists before the handshake completes, so anything sent after connect is replayed later
+        async with async_session_maker() as session:
+            cursor = await DeliveryCursor.get_or_create(session, user_id)
         await websocket.accept()
-        self.active_connections[user_id] = websocket
-        return True
+        connection = ClientConnection(websocket, user_id)
+        connection.start()
+        self.active_connections.setdefault(user_id, set()).add(connection)
+        if self.heartbeat_task is None or self.heartbeat_task.done():
+            self.heartbeat_task = asyncio.create_task(self.heartbeat_loop())
+        connection.backlog = asyncio.create_task(self.push_backlog(connection, cursor.acked_message_id))
+        return connection
+
+    async def push_backlog(self, connection: ClientConnection, after_id: int):
+        # Replays everything after the user's ack cursor in bounded batches. Live messages can overlap
+        # with the replay, so clients de-duplicate by message id.
+        async with async_session_maker() as session:
+            while not connection.closed:
+                messages = await Message.get_backlog(session, connection.user_id, after_id, WS_BACKLOG_BATCH_SIZE)
+                if not messages:
+                    break
+                await connection.put({"type": "backlog", "messages": [message.model_dump(mode="json") for message in messages]})
+                after_id = messages[-1].id
+                if len(messages) < WS_BACKLOG_BATCH_SIZE:
+                    break
+
+    async def resync(self, connection: ClientConnection):
+        # Sent by clients after a gap notice; the replay starts again from the durable ack cursor
+        if connection.backlog:
+            connection.backlog.cancel()
+        async with async_session_maker() as session:
+            cursor = await DeliveryCursor.get_or_create(session, connection.user_id)
+        connection.backlog = asyncio.create_task(self.push_backlog(connection, cursor.acked_message_id))
+
+    async def acknowledge(self, connection: ClientConnection, ranges):
+        try:
+            ranges = [(int(start), int(end)) for start, end in ranges]
+        except (TypeError, ValueError):
+            connection.enqueue({"type": "error", "detail": "Ack ranges must be [[from_id, to_id], ...]"})
+            return
+        try:
+            async with async_session_maker() as session:
+                acked_id = await DeliveryCursor.acknowledge(session, connection.user_id, ranges)
+        except HTTPException as e:
+            connection.enqueue({"type": "error", "detail": e.detail})
+            return
+        connection.enqueue({"type": "ack", "acked_id": acked_id})
+
+    async def disconnect(self, connection: ClientConnection):
+        connections = self.active_connections.get(connection.user_id)
+        if connections is not None:
+            connections.discard(connection)
+            if not connections:
+                self.active_connections.pop(connection.user_id, None)
+        await connection.close()
 
-    async def disconnect(self, user_id: int):
-        if user_id in self.active_connections:
-            self.active_connections.pop(user_id)
+    async def evict(self, connection: ClientConnection, reason: str):
+        await connection.close(code=1008, reason=reason)
+        await self.disconnect(connection)
 
-    async def send_message_to_user(self, message: str, listing_id: int, sender_id: int, session: Session):
-        listing = session.get(Listing, listing_id)
-        if not listing:
-            raise HTTPException(status_code=404, detail="Listing not found")
+    def deliver(self, user_id: int, payload: dict):
+        # Never awaits a socket: frames go onto per-connection queues so a slow receiver cannot stall the sender
+        for connection in list(self.active_connections.get(user_id, ())):
+            if not connection.enqueue(payload):
+                task = asyncio.create_task(self.evict(connection, "Slow consumer"))
+                self.eviction_tasks.add(task)
+                task.add_done_callback(self.eviction_tasks.discard)
+            elif payload.get("type") == "message":
+                websocket_messages.inc(direction="delivered")
 
-        receiver_id = listing.user
-        if receiver_id == sender_id:
-            raise HTTPException(status_code=400, detail="Sender and receiver cannot be the same")
+    async def heartbeat_loop(self):
+        while self.active_connections:
+            await asyncio.sleep(WS_HEARTBEAT_INTERVAL)
+            now = time.monotonic()
+            for connections in list(self.active_connections.values()):
+                for connection in list(connections):
+                    timed_out = WS_HEARTBEAT_TIMEOUT and now - connection.last_seen > WS_HEARTBEAT_TIMEOUT
+                    if connection.closed or timed_out:
+                        await self.evict(connection, "Heartbeat timeout")
+                    elif not connection.enqueue({"type": "ping"}):
+                        await self.evict(connection, "Slow consumer")
 
-        # Save message to the database
-        new_message = Message.create_message(session=session,content=message, sender_id=sender_id, listing_id=listing_id)
-        
+    async def send_message_to_user(self, message: str, listing_id: int, sender_id: int):
+        # Resolves once the batch holding this message has committed, so receivers never see unsaved messages
+        new_message = await message_writer.submit(listing_id, sender_id, message)
 
-        if receiver_id in self.active_connections:
-            websocket = self.active_connections[receiver_id]
-            await websocket.send_json(new_message)
+        await self.broker.publish(new_message.receiver_id, {"type": "message", **new_message.model_dump(mode="json")})
 
 ws_connection_manager = ConnectionManager()
 
-async def websocket_endpoint(websocket: WebSocket, token: str, session: Session = Depends()):
+async def websocket_endpoint(websocket: WebSocket, token: str):
+    connection = None
     try:
         user_id = auth_handler.decode_token(token)
-        await ws_connection_manager.connect(websocket, user_id)
+        connection = await ws_connection_manager.connect(websocket, user_id)
         while True:
             data = await websocket.receive_json()
-            sender_id = auth_handler.decode_token(data["token"])
+            connection.last_seen = time.monotonic()
+            if data.get("type") == "pong":
+                continue
+            if data.get("type") == "ack":
+                # {"type": "ack", "ranges": [[from_id, to_id], ...]}
+                await ws_connection_manager.acknowledge(connection, data.get("ranges") or [])
+                continue
+            if data.get("type") == "resync":
+                await ws_connection_manager.resync(connection)
+                continue
+            if WS_TRUST_CONNECT_IDENTITY:
+                sender_id = user_id
+            else:
+                sender_id = auth_handler.decode_token(data["token"])
             listing_id = data["listing_id"]
             message = data["message"]
 
-            await ws_connection_manager.send_message_to_user(message, listing_id, sender_id, session)
+            await ws_connection_manager.send_message_to_user(message, listing_id, sender_id)
+            websocket_messages.inc(direction="received")
     except WebSocketDisconnect:
         print(f"Client {user_id} disconnected")
-        await ws_connection_manager.disconnect(user_id)
+        if connection:
+            connection.closed = True
+            await ws_connection_manager.disconnect(connection)
     except HTTPException as e:
         await websocket.close(code=1008, reason=e.detail)
-        await ws_connection_manager.disconnect(user_id)
+        if connection:
+            connection.closed = True
+            await ws_connection_manager.disconnect(connection)
     except Exception as e:
         print(f"Unexpected error: {e}")
         await websocket.close(code=1011, reason="Internal server error")
-        await ws_connection_manager.disconnect(user_id)
+        if connection:
+            connection.closed = True
+            await ws_connection_manager.disconnect(connection)